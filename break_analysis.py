@@ -0,0 +1,230 @@
+import os
+# Headless: no window, no sound device. Has to be set before pygame is initialized.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+# One process per core already, keep NumPy's BLAS from starting threads of its own in each of them
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+
+import argparse, itertools, multiprocessing, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from main import Turtle_Pool, SilentInstrument, SLEEP_SPEED, CUSHION_CLEARANCE, cushion_polygon, cushion_segments, points_inside_polygon
+from rules import SHOT_SUMMARY, ALL_BALLS, OPEN, evaluate
+
+ROTATIONS = 12  # The R key turns the table in 30 degree steps
+FLIPS = ((False, False), (True, False), (False, True), (True, True))
+NUM_POCKETS = 7
+MAX_FRAMES = 900
+MAX_SHOT_SPEED = 25.5  # A full pull of the stick, MAX_STICK_LENGTH * 0.1
+
+def _nearest_cushion_point(points, start, edge, inv_length_sq, normals):
+    # Vectorized Turtle_Pool.nearest_cushion_point for (m, 2) points
+    offset = points[:, None] - start
+    t = np.clip(np.einsum('mkd,kd->mk', offset, edge) * inv_length_sq, 0, 1)
+    gap = offset - t[..., None] * edge
+    seg = np.einsum('mkd,mkd->mk', gap, gap).argmin(axis=1)
+    t = t[np.arange(len(points)), seg]
+    closest = start[seg] + t[:, None] * edge[seg]
+    normal = normals[seg]
+    corner = (t == 0) | (t == 1)
+    other = np.where(t == 0, seg - 1, (seg + 1) % len(start))
+    normal = np.where(corner[:, None], normal + normals[other], normal)
+    normal /= np.linalg.norm(normal, axis=1)[:, None]
+    return closest + normal * CUSHION_CLEARANCE, normal
+
+def simulate_breaks(game, speeds, angles, max_frames=MAX_FRAMES):
+    # Plays every break in the batch at once as (breaks, balls, 2) arrays, with the same constants and the same
+    # cushion polygon as the interactive physics. All balls are the same size, so a ball-ball hit swaps the normal components of
+    # their velocities. Simultaneous contacts are resolved together rather than pair by pair as in
+    # Turtle_Pool.handle_ball_collision, which is close enough for statistics.
+    # Breaks whose balls have all stopped are dropped from the arrays, rows maps what is left back to the batch.
+    # Returns the pocket index each ball fell into, -1 if it stayed on the table, and the index of the first ball
+    # the cue ball touched, -1 for none. Ball 0 is the cue ball.
+    breaks = len(speeds)
+    radius = game.cue_ball.radius
+    reach_sq = (2 * radius) ** 2
+    start = np.array([ball.pos.xy for ball in game.balls], dtype=np.float64)
+    count = len(start)
+
+    pos = np.repeat(start[None], breaks, axis=0)
+    vel = np.zeros_like(pos)
+    vel[:, 0, 0] = speeds * np.cos(angles)
+    vel[:, 0, 1] = speeds * np.sin(angles)
+    pocket_of = np.full((breaks, count), -1, dtype=np.int8)
+    first_hit = np.full(breaks, -1, dtype=np.int8)
+    rows = np.arange(breaks)
+
+    # Every pair once, and how each pair's change is spread back onto its two balls
+    first, second = np.triu_indices(count, 1)
+    incidence = np.zeros((len(first), count))
+    incidence[np.arange(len(first)), first] = 1
+    incidence[np.arange(len(first)), second] = -1
+
+    p, direction = game.p, game.direction
+    for _ in range(max_frames):
+        x, y = game.get_polygon_points(p)
+        points = list(zip(x.tolist(), y.tolist()))
+        segments = np.array(cushion_segments(cushion_polygon(points, radius)))
+        seg_start, seg_vec, seg_inv_len_sq, normals = segments[:, 0:2], segments[:, 2:4], segments[:, 4], segments[:, 5:7]
+        holes = np.array([hole.pos.xy for hole in game.generate_holes_from_points(points, NUM_POCKETS)])
+
+        # Ball.move
+        pos += vel
+        vel *= game.FRICTION
+        vel[np.einsum('bnd,bnd->bn', vel, vel) < SLEEP_SPEED * SLEEP_SPEED] = 0
+
+        # Turtle_Pool.move_ball, the screen edges
+        out = (pos - radius <= 0) | (pos + radius >= (game.WIDTH, game.HEIGHT))
+        vel[out] = -vel[out]
+
+        # Rails, a centre that left the cushion goes back to the nearest point on it and bounces if it was heading out
+        hit = ~points_inside_polygon(pos, seg_start, seg_vec) & ~np.isnan(pos[..., 0])
+        if hit.any():
+            pos[hit], normal = _nearest_cushion_point(pos[hit], seg_start, seg_vec, seg_inv_len_sq, normals)
+            along = np.einsum('md,md->m', vel[hit], normal)
+            vel[hit] -= 2 * np.minimum(along, 0)[:, None] * normal
+
+        # Pockets, a ball that drops leaves the table as NaN so no later test matches it
+        hole_offset = pos[:, :, None, :] - holes
+        in_hole = np.einsum('bnhd,bnhd->bnh', hole_offset, hole_offset) < game.holes[0].radius ** 2
+        dropped = in_hole.any(axis=-1)
+        if dropped.any():
+            row, ball = np.nonzero(dropped)
+            pocket_of[rows[row], ball] = in_hole[row, ball].argmax(axis=-1)
+            pos[dropped] = np.nan
+            vel[dropped] = 0
+
+        # Ball-ball
+        diff = pos[:, first] - pos[:, second]
+        dist_sq = np.einsum('bkd,bkd->bk', diff, diff)
+        colliding = dist_sq < reach_sq
+        touched = np.flatnonzero(colliding.any(axis=1))
+        if len(touched):
+            colliding, diff, dist_sq = colliding[touched], diff[touched], dist_sq[touched]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                dist = np.sqrt(dist_sq)
+                normal = np.where(colliding[..., None], diff / dist[..., None], 0)
+            overlap = np.where(colliding, 2 * radius - dist, 0)
+            # The cue ball's pairs (0, 1), (0, 2), ... come first in triu order
+            cue_pairs = colliding[:, :count - 1]
+            hit = cue_pairs.any(axis=1)
+            hit_rows = rows[touched][hit]
+            fresh = first_hit[hit_rows] < 0
+            first_hit[hit_rows[fresh]] = cue_pairs[hit].argmax(axis=1)[fresh] + 1
+            exchange = np.einsum('bkd,bkd->bk', vel[touched][:, second] - vel[touched][:, first], normal)
+            # (breaks, 2, pairs) @ (pairs, balls) sums every pair's push and impulse onto its balls
+            pos[touched] += (np.swapaxes(normal * (overlap / 2)[..., None], 1, 2) @ incidence).swapaxes(1, 2)
+            vel[touched] += (np.swapaxes(normal * exchange[..., None], 1, 2) @ incidence).swapaxes(1, 2)
+
+        p += direction * game.delta_p
+        if p > 1:
+            p, direction = 1, -1
+        elif p < 0:
+            p, direction = 0, 1
+        moving = vel.any(axis=(1, 2))
+        if not moving.all():
+            rows, pos, vel = rows[moving], pos[moving], vel[moving]
+            if not len(rows):
+                break
+    return pocket_of, first_hit
+
+def break_summaries(game, pocket_of, first_hit):
+    # One SHOT_SUMMARY per simulated break so the rules engine can score the whole batch at once.
+    # The break doesn't need the rail rule, only a scratch is a foul there.
+    numbers = np.array([ball.number for ball in game.balls])
+    summaries = np.zeros(len(pocket_of), dtype=SHOT_SUMMARY)
+    summaries['on_table'] = ALL_BALLS
+    summaries['group'] = OPEN
+    summaries['is_break'] = True
+    summaries['first_contact'] = np.where(first_hit >= 0, numbers[first_hit], -1)
+    summaries['first_pocketed'] = -1
+    summaries['pocketed'] = ((pocket_of[:, 1:] >= 0) << numbers[1:]).sum(axis=1)
+    summaries['rail_after_contact'] = True
+    summaries['scratch'] = pocket_of[:, 0] >= 0
+    return summaries
+
+_game = None
+
+def _init_worker():
+    global _game
+    _game = Turtle_Pool(instrument=SilentInstrument())
+
+def analyze_setup(task):
+    # One (p, rotation, flip) combination: rack the table that way and break many times with varied aim and power
+    p, rotation, flip, breaks, spread, min_speed, max_speed, seed = task
+    game = _game
+    game.p = p
+    game.direction = -1 if p >= 1 else 1
+    game.rotation_angle = rotation * np.pi / 6
+    game.flip_x, game.flip_y = flip
+    game.setup_balls()
+    game.update_table(p)
+
+    rng = np.random.default_rng(seed)
+    aim = game.balls[1].pos - game.cue_ball.pos  # Straight at the head ball of the rack
+    angles = np.arctan2(aim.y, aim.x) + np.radians(rng.uniform(-spread, spread, breaks))
+    speeds = rng.uniform(min_speed, max_speed, breaks)
+    pocket_of, first_hit = simulate_breaks(game, speeds, angles)
+    results = evaluate(break_summaries(game, pocket_of, first_hit))
+
+    objects = pocket_of[:, 1:]
+    pocket_hit = (objects[..., None] == np.arange(NUM_POCKETS)).any(axis=1)
+    scratched = pocket_of[:, 0] >= 0
+    pocketed = (objects >= 0).sum(axis=1)
+    return (pocket_hit.mean(axis=0), scratched.mean(), pocketed.mean(), results['continues'].mean(),
+            (results['outcome'] > 0).mean(), (results['outcome'] < 0).mean())
+
+def analyze(p_values, breaks=1000, spread=2.0, min_speed=15.0, max_speed=MAX_SHOT_SPEED, seed=0, workers=None):
+    setups = list(itertools.product(range(len(p_values)), range(ROTATIONS), range(len(FLIPS))))
+    tasks = [(float(p_values[i]), r, FLIPS[f], breaks, spread, min_speed, max_speed, seed + n)
+             for n, (i, r, f) in enumerate(setups)]
+
+    shape = (len(p_values), ROTATIONS, len(FLIPS))
+    pocket_probability = np.zeros(shape + (NUM_POCKETS,))
+    scratch_rate = np.zeros(shape)
+    mean_pocketed = np.zeros(shape)
+    breaker_continues = np.zeros(shape)
+    breaker_wins = np.zeros(shape)
+    breaker_loses = np.zeros(shape)
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1, mp_context=context, initializer=_init_worker) as pool:
+        for index, result in zip(setups, pool.map(analyze_setup, tasks)):
+            (pocket_probability[index], scratch_rate[index], mean_pocketed[index], breaker_continues[index],
+             breaker_wins[index], breaker_loses[index]) = result
+
+    return {
+        'p': np.asarray(p_values, dtype=np.float64),
+        'rotation_degrees': np.arange(ROTATIONS) * 30,
+        'flips': np.array(FLIPS),  # (flip_x, flip_y) per index of the flip axis
+        'pocket_probability': pocket_probability,  # Chance that a break drops at least one object ball in each pocket
+        'scratch_rate': scratch_rate,
+        'mean_pocketed': mean_pocketed,
+        'breaker_continues': breaker_continues,  # Stays at the table by the 8-ball rules (rules.evaluate)
+        'breaker_wins': breaker_wins,  # 8 down on the break without a scratch
+        'breaker_loses': breaker_loses,  # 8 down together with a scratch
+        'breaks': np.array(breaks),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Break statistics for every table phase, rotation and flip')
+    parser.add_argument('out', help='.npz file to write')
+    parser.add_argument('--breaks', type=int, default=1000, help='break shots per table setup')
+    parser.add_argument('--p-steps', type=int, default=11, help='p values from 0 to 1')
+    parser.add_argument('--spread', type=float, default=2.0, help='aim error in degrees either side of the head ball')
+    parser.add_argument('--min-speed', type=float, default=15.0)
+    parser.add_argument('--max-speed', type=float, default=MAX_SHOT_SPEED)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='processes to use (default: all cores)')
+    args = parser.parse_args()
+
+    began = time.perf_counter()
+    results = analyze(np.linspace(0, 1, args.p_steps), args.breaks, args.spread, args.min_speed, args.max_speed, args.seed, args.workers)
+    np.savez_compressed(args.out, **results)
+
+    best = np.unravel_index(results['breaker_continues'].argmax(), results['breaker_continues'].shape)
+    print(f"{results['scratch_rate'].size} setups x {args.breaks} breaks in {time.perf_counter() - began:.0f} s")
+    print(f"best for the breaker: p={results['p'][best[0]]:.2f}, rotation {results['rotation_degrees'][best[1]]} deg, "
+          f"flip {tuple(results['flips'][best[2]].tolist())}, continues {results['breaker_continues'][best]:.0%}")
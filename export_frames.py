@@ -0,0 +1,102 @@
+import os
+# Headless: no window, no sound device. Has to be set before pygame is initialized.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse, json, multiprocessing, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pygame
+
+from main import Turtle_Pool, SilentInstrument
+
+SETTLE_FRAMES = 1800  # After the last input keep going until the table rests, at most this long
+
+def load_replay(path):
+    with open(path) as file:
+        replay = json.load(file)
+    inputs = {}
+    for frame, kind, data, p, direction in replay['inputs']:
+        inputs.setdefault(frame, []).append((kind, data, p, direction))
+    advances = {frame: steps for frame, steps in replay['advances']}
+    return replay, inputs, advances
+
+def headless_game():
+    return Turtle_Pool(instrument=SilentInstrument())
+
+def plan_chunks(replay_path, start, end, chunk_size):
+    # Fast serial pass without drawing. Records the full state at the start of every chunk so the
+    # workers can each jump straight to their own range.
+    replay, inputs, advances = load_replay(replay_path)
+    game = headless_game()
+    game.import_state(replay['start'])
+    last_input = max(inputs, default=0)
+    settle = end is None
+    if settle:
+        end = last_input + SETTLE_FRAMES
+
+    chunks = []
+    frame = 0
+    while frame < end:
+        if frame >= start and (frame - start) % chunk_size == 0:
+            chunks.append((frame, min(frame + chunk_size, end), game.export_state(), game.get_stick_state()))
+        game.replay_frame(inputs.get(frame, ()), advances.get(frame, 1))
+        frame += 1
+        if settle and frame > last_input and not game.ball_was_moving:
+            end = frame  # Table at rest after the last shot, nothing more to show
+    pygame.quit()
+    return [(first, min(last, end), state, stick) for first, last, state, stick in chunks if first < end]
+
+_worker_game = None
+_worker_replay = None
+
+def _init_worker(replay_path):
+    global _worker_game, _worker_replay
+    _worker_game = headless_game()
+    _worker_replay = load_replay(replay_path)
+
+def render_chunk(chunk, out_dir, image_format):
+    # Re-simulates one frame range from its snapshot and draws it with the game's own drawing code
+    first, last, state, stick = chunk
+    game = _worker_game
+    _, inputs, advances = _worker_replay
+    game.import_state(state)
+    game.set_stick_state(stick)
+    for frame in range(first, last):
+        snapshot = game.replay_frame(inputs.get(frame, ()), advances.get(frame, 1))
+        game.render_snapshot(snapshot)
+        name = os.path.join(out_dir, f'frame_{frame:06d}')
+        if image_format == 'png':
+            pygame.image.save(game.screen, name + '.png')
+        else:
+            # Raw (height, width, 3) RGB, surfarray is indexed x first
+            np.save(name + '.npy', pygame.surfarray.array3d(game.screen).transpose(1, 0, 2))
+    return last - first
+
+def export(replay_path, out_dir, image_format='png', start=0, end=None, workers=None, chunk_size=120):
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    began = time.perf_counter()
+    chunks = plan_chunks(replay_path, start, end, chunk_size)
+
+    frames = 0
+    # Spawned workers start with a clean pygame instead of a forked copy of this process's display
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(replay_path,)) as pool:
+        for count in pool.map(render_chunk, chunks, [out_dir] * len(chunks), [image_format] * len(chunks)):
+            frames += count
+    return frames, time.perf_counter() - began
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a Turtle Pool replay (main.py --record) to image files')
+    parser.add_argument('replay')
+    parser.add_argument('out_dir')
+    parser.add_argument('--format', choices=('png', 'npy'), default='png', help='PNG sequence or raw RGB arrays')
+    parser.add_argument('--start', type=int, default=0, help='first frame to render')
+    parser.add_argument('--end', type=int, help='frame to stop at (default: when the table rests after the last shot)')
+    parser.add_argument('--workers', type=int, help='processes to render with (default: all cores)')
+    parser.add_argument('--chunk', type=int, default=120, help='frames per work item')
+    args = parser.parse_args()
+
+    frames, seconds = export(args.replay, args.out_dir, args.format, args.start, args.end, args.workers, args.chunk)
+    print(f"{frames} frames in {seconds:.1f} s ({frames / seconds:.0f} fps, {frames / seconds / 60:.1f}x real time)")
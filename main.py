@@ -1,13 +1,22 @@
 import pygame, math, time
-from pygame.locals import QUIT, KEYDOWN, MOUSEBUTTONDOWN, MOUSEBUTTONUP
+from pygame.locals import QUIT, KEYDOWN, MOUSEBUTTONDOWN, MOUSEBUTTONUP, MOUSEMOTION, NOEVENT
 import numpy as np
 from pygame.math import Vector2
 import pygame.gfxdraw
-import mido, threading
+import mido, threading, zlib, queue, json, struct
+from collections import deque, namedtuple
+from netplay import LockstepPeer
+from spectator import SpectatorServer
+from rules import OPEN, SOLIDS, STRIPES, SHOT_SUMMARY, new_shot, ball_mask, evaluate
+
+SLEEP_SPEED = 0.01  # Below this many pixels per frame a ball is put to rest
 
 class Ball:
-    def __init__(self, pos, color, is_striped=False):
+    __slots__ = ('pos', 'number', 'vel', 'color', 'is_striped', 'radius', 'angle', 'offset', 'offset_direction')
+
+    def __init__(self, pos, color, is_striped=False, number=0):
         self.pos = Vector2(pos)
+        self.number = number  # 0 is the cue ball, 1-7 solids, 8 the black ball, 9-15 stripes
         self.vel = Vector2(0, 0)
         self.color = color
         self.is_striped = is_striped
@@ -19,10 +28,14 @@ class Ball:
     def move(self):
         self.pos += self.vel
         self.vel *= 0.98  # Friction
-        self.angle += self.vel.length() * 0.05
+        speed = self.vel.length()
+        if speed < SLEEP_SPEED:
+            self.vel.update(0, 0)  # Friction alone would take minutes to reach an exact stop
+            speed = 0
+        self.angle += speed * 0.05
         
         # Only adjust the stripe offset when the ball is in motion
-        if self.vel.length() > 0.1:  # Change 0.1 to a suitable threshold if needed
+        if speed > 0.1:  # Change 0.1 to a suitable threshold if needed
             self.offset += self.offset_direction / 4
             if self.offset > self.radius or self.offset < -self.radius:
                 self.offset_direction *= -1
@@ -68,6 +81,8 @@ class Ball:
         pygame.draw.circle(screen, (0, 0, 0), (int(self.pos.x), int(self.pos.y)), self.radius + 2, 2)
 
 class Hole:
+    __slots__ = ('pos', 'radius', 'color')
+
     def __init__(self, pos):
         self.pos = Vector2(pos)
         self.radius = 12  # Slightly larger than a ball
@@ -76,11 +91,202 @@ class Hole:
     def draw(self, screen):
         pygame.draw.circle(screen, self.color, (int(self.pos.x), int(self.pos.y)), self.radius)
 
+# Physics events, emitted during a step and consumed by audio, scoring and replay afterwards
+BALL_BALL, BALL_RAIL, POCKET, SCRATCH = 1, 2, 3, 4
+COLLISION_EVENT = np.dtype([
+    ('kind', 'u1'),
+    ('frame', '<u4'),
+    ('a', 'i1'),  # Ball number
+    ('b', 'i1'),  # Other ball number for BALL_BALL, hole index for POCKET/SCRATCH, -1 otherwise
+    ('speed', '<f4'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+])
+
+class EventRing:
+    # Fixed size ring buffer of COLLISION_EVENT records, nothing is allocated while the physics step emits.
+    # If more than capacity events pile up between drains the oldest are overwritten.
+    def __init__(self, capacity=1024):
+        self.buffer = np.zeros(capacity, dtype=COLLISION_EVENT)
+        self.capacity = capacity
+        self.head = 0  # Index of the oldest undrained event
+        self.count = 0
+        self.frame = 0
+
+    def emit(self, kind, a, b, speed, x, y):
+        index = (self.head + self.count) % self.capacity
+        self.buffer[index] = (kind, self.frame, a, b, speed, x, y)
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.head = (self.head + 1) % self.capacity
+
+    def drain(self):
+        # Returns the pending events in order. Usually a view into the buffer, only valid until the next emit.
+        start, count = self.head, self.count
+        self.head = (start + count) % self.capacity
+        self.count = 0
+        if start + count <= self.capacity:
+            return self.buffer[start:start + count]
+        return np.concatenate((self.buffer[start:], self.buffer[:start + count - self.capacity]))
+
+# One ball of a GameState, in table order
+BALL_STATE = np.dtype([
+    ('number', 'u1'),
+    ('x', '<f8'), ('y', '<f8'), ('vx', '<f8'), ('vy', '<f8'),
+    ('angle', '<f8'), ('offset', '<f8'), ('offset_direction', 'i1'),
+    ('r', 'u1'), ('g', 'u1'), ('b', 'u1'), ('striped', '?'),
+])
+# cue index, scores, current player, p, direction, rotation, flags, shot count, ball count
+GAME_STATE_HEADER = struct.Struct('<BhhBdbdBIBBBB')
+UNDO_LIMIT = 32
+
+class GameState:
+    # Everything the simulation depends on, packed into one array of balls plus a few scalars.
+    # Capturing, copying and restoring are O(balls) with no Ball objects created, so undo is instant and
+    # search code can branch from a position many times over. export_state/import_state and the state
+    # hash are built on it.
+    __slots__ = ('balls', 'cue', 'score_player1', 'score_player2', 'current_player', 'p', 'direction',
+                 'rotation_angle', 'flip_x', 'flip_y', 'shot_count', 'ball_was_moving', 'groups', 'winner', 'is_break', 'shot')
+
+    def __init__(self, balls, cue, score_player1=0, score_player2=0, current_player=1, p=0.0, direction=1,
+                 rotation_angle=0.0, flip_x=False, flip_y=False, shot_count=0, ball_was_moving=False, groups=(OPEN, OPEN),
+                 winner=0, is_break=True, shot=None):
+        self.balls = balls
+        self.cue = cue
+        self.score_player1 = score_player1
+        self.score_player2 = score_player2
+        self.current_player = current_player
+        self.p = p
+        self.direction = direction
+        self.rotation_angle = rotation_angle
+        self.flip_x = flip_x
+        self.flip_y = flip_y
+        self.shot_count = shot_count
+        self.ball_was_moving = ball_was_moving
+        self.groups = tuple(groups)
+        self.winner = winner
+        self.is_break = is_break
+        self.shot = shot  # SHOT_SUMMARY of the shot still rolling, None at rest
+
+    @classmethod
+    def capture(cls, game):
+        balls = np.empty(len(game.balls), dtype=BALL_STATE)
+        for i, ball in enumerate(game.balls):
+            balls[i] = (ball.number, ball.pos.x, ball.pos.y, ball.vel.x, ball.vel.y, ball.angle, ball.offset,
+                        ball.offset_direction, *ball.color, ball.is_striped)
+        return cls(balls, game.balls.index(game.cue_ball), game.score_player1, game.score_player2,
+                   game.current_player, game.p, game.direction, game.rotation_angle, game.flip_x, game.flip_y,
+                   game.shot_count, game.ball_was_moving, game.groups, game.winner, game.is_break,
+                   None if game.shot is None else game.shot.copy())
+
+    def restore(self, game):
+        # Ball objects already on the table are updated in place, only balls that come back from a pocket
+        # are created again
+        on_table = {ball.number: ball for ball in game.balls}
+        on_table.setdefault(game.cue_ball.number, game.cue_ball)
+        balls = []
+        for number, x, y, vx, vy, angle, offset, offset_direction, r, g, b, striped in self.balls.tolist():
+            ball = on_table.get(number)
+            if ball is None:
+                ball = Ball(Vector2(x, y), (r, g, b), striped, number)
+            ball.pos.update(x, y)
+            ball.vel.update(vx, vy)
+            ball.angle, ball.offset, ball.offset_direction = angle, offset, offset_direction
+            ball.color, ball.is_striped = (r, g, b), striped
+            balls.append(ball)
+        game.balls = balls
+        game.cue_ball = balls[self.cue]
+        game.score_player1, game.score_player2 = self.score_player1, self.score_player2
+        game.current_player = self.current_player
+        game.p, game.direction = self.p, self.direction
+        game.rotation_angle, game.flip_x, game.flip_y = self.rotation_angle, self.flip_x, self.flip_y
+        game.shot_count = self.shot_count
+        game.ball_was_moving = self.ball_was_moving
+        game.groups, game.winner, game.is_break = list(self.groups), self.winner, self.is_break
+        game.shot = None if self.shot is None else self.shot.copy()
+
+    def copy(self):
+        return GameState(self.balls.copy(), self.cue, self.score_player1, self.score_player2, self.current_player,
+                         self.p, self.direction, self.rotation_angle, self.flip_x, self.flip_y, self.shot_count,
+                         self.ball_was_moving, self.groups, self.winner, self.is_break,
+                         None if self.shot is None else self.shot.copy())
+
+    @property
+    def pocketed(self):
+        # Bit n is set while ball number n is off the table
+        return ~int(np.bitwise_or.reduce(1 << self.balls['number'].astype(np.int64), initial=0)) & 0xFFFF
+
+    def hash(self):
+        # Cheap desync check, quantized so last-bit float noise isn't mistaken for a desync
+        scalars = np.array([self.p, self.direction, self.rotation_angle, self.flip_x, self.flip_y,
+                            self.current_player, self.score_player1, self.score_player2, *self.groups, self.winner],
+                           dtype=np.float64)
+        motion = np.column_stack((self.balls['x'], self.balls['y'], self.balls['vx'], self.balls['vy']))
+        return zlib.crc32(np.round(motion, 3).tobytes(), zlib.crc32(np.round(scalars, 3).tobytes()))
+
+    def to_bytes(self):
+        flags = (self.flip_x | self.flip_y << 1 | self.ball_was_moving << 2 | self.is_break << 3
+                 | (self.shot is not None) << 4)
+        header = GAME_STATE_HEADER.pack(self.cue, self.score_player1, self.score_player2, self.current_player,
+                                        self.p, self.direction, self.rotation_angle, flags, self.shot_count, len(self.balls),
+                                        *self.groups, self.winner)
+        shot = b'' if self.shot is None else self.shot.tobytes()
+        return header + self.balls.tobytes() + shot
+
+    @classmethod
+    def from_bytes(cls, data):
+        (cue, score1, score2, current_player, p, direction, rotation_angle, flags, shot_count, count,
+         group1, group2, winner) = GAME_STATE_HEADER.unpack_from(data)
+        balls = np.frombuffer(data, BALL_STATE, count, GAME_STATE_HEADER.size).copy()
+        shot = None
+        if flags & 16:
+            shot = np.frombuffer(data, SHOT_SUMMARY, 1, GAME_STATE_HEADER.size + balls.nbytes).reshape(()).copy()
+        return cls(balls, cue, score1, score2, current_player, p, direction, rotation_angle, bool(flags & 1),
+                   bool(flags & 2), shot_count, bool(flags & 4), (group1, group2), winner, bool(flags & 8), shot)
+
+    def to_dict(self):
+        # Plain JSON-friendly values, the format of network resyncs and replays
+        return {
+            'balls': [[x, y, vx, vy, [r, g, b], striped, angle, offset, offset_direction, number]
+                      for number, x, y, vx, vy, angle, offset, offset_direction, r, g, b, striped in self.balls.tolist()],
+            'cue': self.cue,
+            'scores': [self.score_player1, self.score_player2],
+            'current_player': self.current_player,
+            'p': self.p,
+            'direction': self.direction,
+            'rotation_angle': self.rotation_angle,
+            'flip_x': self.flip_x,
+            'flip_y': self.flip_y,
+            'shot_count': self.shot_count,
+            'ball_was_moving': self.ball_was_moving,
+            'groups': list(self.groups),
+            'winner': self.winner,
+            'is_break': self.is_break,
+            'shot': None if self.shot is None else list(self.shot.tolist()),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        # Replays recorded before the rules engine have no groups, winner or shot and start on an open table
+        shot = state.get('shot')
+        if shot is not None:
+            shot = np.array(tuple(shot), dtype=SHOT_SUMMARY)
+        balls = np.array([(number, x, y, vx, vy, angle, offset, offset_direction, *color, is_striped)
+                          for x, y, vx, vy, color, is_striped, angle, offset, offset_direction, number in state['balls']],
+                         dtype=BALL_STATE)
+        return cls(balls, state['cue'], *state['scores'], state['current_player'], state['p'], state['direction'],
+                   state['rotation_angle'], state['flip_x'], state['flip_y'], state['shot_count'],
+                   state['ball_was_moving'], state.get('groups', (OPEN, OPEN)), state.get('winner', 0),
+                   state.get('is_break', False), shot)
+
 MAX_STICK_LENGTH = 255  # Set this appropriately for maximum power.
-STICK_DRIFT = .2  # Maximum random drift in pixels.
 MAX_OFFSET = 64  # This value determines the maximum distance the stick can be pulled back.
 
 class PoolStick:
+    __slots__ = ('start_position', 'end_position', 'is_visible', 'thickness_tip', 'thickness_base',
+                 'border_color', 'base_color', 'gradient_colors', 'ferrule_offset')
+
     def __init__(self):
         self.start_position = Vector2(0, 0)
         self.end_position = Vector2(0, 0)
@@ -99,13 +305,13 @@ class PoolStick:
         self.ferrule_offset = 5  # Adjust this to control the length of the ferrule
 
     def set_start_position(self, pos):
-        self.start_position = Vector2(pos)
+        self.start_position.update(pos)
         
     def update_start_position(self, pos):
-        self.start_position = Vector2(pos)
+        self.start_position.update(pos)
         
     def set_end_position(self, pos):
-        self.end_position = Vector2(pos)
+        self.end_position.update(pos)
 
     def _calculate_direction_and_magnitude(self):
         direction = self.end_position - self.start_position
@@ -167,8 +373,343 @@ class PoolStick:
         pygame.draw.circle(screen, (127, 127, 255), self.start_position, 3)
         pygame.draw.circle(screen, (40, 40, 40), self.end_position, self.thickness_base / 2)
 
-class Turtle_Pool:
+CUSHION_ARC_STEP = math.pi / 8  # Concave corners of the cushion are rounded off with segments this many radians apart
+CUSHION_CLEARANCE = 0.01  # How far inside the cushion a ball is put back when it crosses it
+
+def _signed_area2(points):
+    # Twice the signed area, positive when the points wind counter-clockwise
+    total = 0.0
+    for i in range(len(points)):
+        x0, y0 = points[i - 1]
+        x1, y1 = points[i]
+        total += x0 * y1 - x1 * y0
+    return total
+
+def cushion_polygon(points, radius):
+    # The table shrunk by the ball radius, the area a ball's centre can be in. A ball touches a rail exactly
+    # when its centre leaves this polygon, so every rail test becomes a point test.
+    # Convex corners turn into the meeting point of the two pushed-in rails. At the Spectre's concave corners
+    # the ball rolls around the corner itself, so the cushion follows an arc of the ball radius there.
+    n = len(points)
+    side = 1 if _signed_area2(points) > 0 else -1
+    normals = []  # Inward unit normal of the rail starting at each point
+    for i in range(n):
+        sx, sy = points[i]
+        ex, ey = points[(i + 1) % n]
+        length = math.hypot(ex - sx, ey - sy)
+        normals.append((-(ey - sy) * side / length, (ex - sx) * side / length))
+
+    cushion = []
+    for i in range(n):
+        px, py = points[i]
+        ax, ay = normals[i - 1]
+        bx, by = normals[i]
+        turn = (ax * by - ay * bx) * side
+        if turn >= 0:  # Convex corner
+            scale = radius / (1 + ax * bx + ay * by)
+            cushion.append((px + (ax + bx) * scale, py + (ay + by) * scale))
+        else:
+            start = math.atan2(ay, ax)
+            sweep = math.atan2(ax * by - ay * bx, ax * bx + ay * by)
+            steps = max(1, math.ceil(abs(sweep) / CUSHION_ARC_STEP))
+            for k in range(steps + 1):
+                angle = start + sweep * k / steps
+                cushion.append((px + radius * math.cos(angle), py + radius * math.sin(angle)))
+    return cushion
+
+def cushion_segments(cushion):
+    # Edges as (start x, start y, dx, dy, 1 / length squared, inward normal x, inward normal y)
+    side = 1 if _signed_area2(cushion) > 0 else -1
+    segments = []
+    for i in range(len(cushion)):
+        sx, sy = cushion[i]
+        ex, ey = cushion[(i + 1) % len(cushion)]
+        dx, dy = ex - sx, ey - sy
+        length = math.hypot(dx, dy)
+        segments.append((sx, sy, dx, dy, 1 / (dx * dx + dy * dy), -dy * side / length, dx * side / length))
+    return segments
+
+def points_inside_polygon(points, start, edge):
+    # Vectorized point_inside_polygon for (..., 2) points against edges given as start and direction, NaN is outside
+    x, y = points[..., None, 0], points[..., None, 1]
+    crosses = (start[:, 1] < y) != (start[:, 1] + edge[:, 1] < y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at_x = start[:, 0] + (y - start[:, 1]) / edge[:, 1] * edge[:, 0]
+    return (crosses & (at_x < x)).sum(axis=-1) % 2 == 1
+
+PLACEMENT_CLEARANCE = 0.05  # Gap left between a placed ball and the ball it is snapped against
+
+class BallInHand:
+    # Where the cue ball may be put down: inside the cushion and clear of every other ball.
+    # The nearest legal spot to a requested one lies on the border of that area, either straight out from one
+    # rail or ball (a ball rules out a circle of twice its radius) or where two of those borders meet. All
+    # of those candidates are built and checked at once with NumPy, cheap enough to follow the mouse.
+    def __init__(self):
+        self.requested = None
+        self.preview = None  # (x, y, requested x, requested y) while the player is placing
+
+    def snap(self, game, pos, ball=None):
+        # Nearest legal position to pos for ball (ignored as an obstacle), pos itself if it is legal already,
+        # None if the table is too full
+        radius = game.cue_ball.radius
+        reach = 2 * radius + PLACEMENT_CLEARANCE
+        segments = np.array(game.cushion_segments, dtype=np.float64)
+        start, edge, inv_length_sq, normal = segments[:, 0:2], segments[:, 2:4], segments[:, 4], segments[:, 5:7]
+        others = np.array([other.pos.xy for other in game.balls if other is not ball], dtype=np.float64).reshape(-1, 2)
+        point = np.array((pos[0], pos[1]), dtype=np.float64)
+        if self._legal(point[None], start, edge, others, 2 * radius)[0]:
+            return Vector2(point[0], point[1])
+
+        # Straight in from each rail, and the cushion's corners
+        t = np.clip(np.einsum('kd,kd->k', point - start, edge) * inv_length_sq, 0, 1)
+        candidates = [start + t[:, None] * edge + normal * CUSHION_CLEARANCE]
+        bisector = normal + np.roll(normal, 1, axis=0)
+        candidates.append(start + bisector / np.linalg.norm(bisector, axis=1)[:, None] * CUSHION_CLEARANCE)
+
+        if len(others):
+            # Straight out from each ball
+            away = point - others
+            distance = np.linalg.norm(away, axis=1)[:, None]
+            away = np.where(distance > 0, away / np.where(distance > 0, distance, 1), (1.0, 0.0))
+            candidates.append(others + away * reach)
+
+            # Between two balls, where their circles cross
+            first, second = np.triu_indices(len(others), 1)
+            between = others[second] - others[first]
+            length = np.linalg.norm(between, axis=1)
+            close = (length > 0) & (length < 2 * reach)
+            if close.any():
+                between, length, base = between[close], length[close, None], others[first[close]]
+                middle = base + between / 2
+                across = np.column_stack((-between[:, 1], between[:, 0])) / length
+                height = np.sqrt(reach * reach - (length / 2) ** 2)
+                candidates += [middle + across * height, middle - across * height]
+
+            # Where a ball's circle meets a rail, solved as |rail start + u * edge - center| = reach
+            rail_start = start + normal * CUSHION_CLEARANCE
+            offset = rail_start[None] - others[:, None]
+            a = np.einsum('kd,kd->k', edge, edge)
+            b = 2 * np.einsum('kd,bkd->bk', edge, offset)
+            c = np.einsum('bkd,bkd->bk', offset, offset) - reach * reach
+            discriminant = b * b - 4 * a * c
+            hits = discriminant >= 0
+            root = np.sqrt(np.where(hits, discriminant, 0))
+            for u in ((-b - root) / (2 * a), (-b + root) / (2 * a)):
+                on_rail = hits & (u >= 0) & (u <= 1)
+                candidates.append((rail_start[None] + u[..., None] * edge[None])[on_rail])
+
+        candidates = np.concatenate(candidates)
+        legal = candidates[self._legal(candidates, start, edge, others, 2 * radius)]
+        if not len(legal):
+            return None
+        nearest = legal[np.einsum('nd,nd->n', legal - point, legal - point).argmin()]
+        return Vector2(nearest[0], nearest[1])
+
+    def _legal(self, points, start, edge, others, min_distance):
+        legal = points_inside_polygon(points, start, edge)
+        if len(others):
+            gap = points[:, None] - others
+            legal &= (np.einsum('nbd,nbd->nb', gap, gap) >= min_distance * min_distance).all(axis=1)
+        return legal
+
+    def update_preview(self, game, pos=None):
+        # Called on mouse motion, and every frame with the last position since the table keeps morphing
+        if pos is not None:
+            self.requested = (pos[0], pos[1])
+        snapped = self.snap(game, self.requested, game.cue_ball)
+        self.preview = None if snapped is None else (snapped.x, snapped.y, *self.requested)
+
+    def draw(self, screen, preview):
+        # Ghost cue ball where it would go, red with a line back to the mouse when it had to be moved
+        x, y, requested_x, requested_y = preview
+        moved = abs(x - requested_x) > 0.5 or abs(y - requested_y) > 0.5
+        color = (255, 80, 80) if moved else (255, 255, 255)
+        if moved:
+            pygame.draw.line(screen, color, (requested_x, requested_y), (x, y), 1)
+        pygame.draw.circle(screen, color, (int(x), int(y)), 10, 1)
+
+AIM_ANGLE_STEPS = 2880  # Aim preview is cached per 1/8 of a degree
+AIM_CACHE_SIZE = 512
+AIM_MAX_BOUNCES = 3
+AIM_MAX_LENGTH = 2500  # Total length of the cue ball's ghost path in pixels
+AIM_OBJECT_LENGTH = 200  # Length of the object ball's direction hint
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+def _ray_circles(origin, direction, centers, radius):
+    # Distance along the ray to the first touch of each circle, inf where it misses
+    to_center = centers - origin
+    along = to_center @ direction
+    miss_sq = np.einsum('ij,ij->i', to_center, to_center) - along * along
+    gap = radius * radius - miss_sq
+    t = along - np.sqrt(np.maximum(gap, 0))
+    return np.where((gap > 0) & (t > 1e-6), t, np.inf)
+
+class TrajectoryPreview:
+    # Ghost path of the cue ball while aiming: rail rebounds off the current table up to the first ball it
+    # touches, and the direction that ball will be sent. The cue ball's centre is ray cast with NumPy against the
+    # cushion polygon and the balls, and cached per quantized aim angle.
+    def __init__(self):
+        self.context = None
+        self.cache = {}
+        self.path = []
+        self.ghost = None
+        self.object_path = None
+        self.color = (255, 255, 255)
+
+    def update(self, game, cue_ball, shot_direction):
+        if shot_direction.length_squared() == 0:
+            return
+        others = [ball for ball in game.balls if ball is not cue_ball]
+        centers = np.array([ball.pos.xy for ball in others], dtype=np.float64).reshape(-1, 2)
+        # The table morphs every frame, a 1% p bucket keeps the cache useful while staying within a pixel or two
+        context = (int(game.p * 100), game.rotation_angle, game.flip_x, game.flip_y,
+                   cue_ball.pos.xy, np.rint(centers).astype(np.int32).tobytes())
+        if context != self.context:
+            self.context = context
+            self.cache.clear()
+            segments = np.array(game.cushion_segments, dtype=np.float64)
+            self.rail_start, self.rail_edge, self.rail_normal = segments[:, 0:2], segments[:, 2:4], segments[:, 5:7]
+            self.centers = centers
+            self.holes = np.array([hole.pos.xy for hole in game.holes], dtype=np.float64).reshape(-1, 2)
+            self.hole_radius = game.holes[0].radius if game.holes else 0
+
+        angle_bin = int(round(math.atan2(shot_direction.y, shot_direction.x) / (2 * math.pi) * AIM_ANGLE_STEPS)) % AIM_ANGLE_STEPS
+        result = self.cache.get(angle_bin)
+        if result is None:
+            if len(self.cache) >= AIM_CACHE_SIZE:
+                self.cache.clear()
+            angle = angle_bin * 2 * math.pi / AIM_ANGLE_STEPS
+            result = self._cast(np.array(cue_ball.pos.xy), np.array((math.cos(angle), math.sin(angle))), cue_ball.radius)
+            self.cache[angle_bin] = result
+        self.path, self.ghost, self.object_path = result
+
+    def _cast_rails(self, origin, direction):
+        # First point where the ball's centre reaches the cushion, returns distance and the rail normal there
+        edge = self.rail_edge
+        to_start = self.rail_start - origin
+        denom = _cross(direction, edge)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = _cross(to_start, edge) / denom
+            u = _cross(to_start, direction) / denom
+        t = np.where((denom != 0) & (u >= 0) & (u <= 1) & (t > 1e-6), t, np.inf)
+        i = int(np.argmin(t))
+        return t[i], self.rail_normal[i]
+
+    def _cast(self, origin, direction, radius):
+        path = [tuple(origin)]
+        remaining = AIM_MAX_LENGTH
+        for _ in range(AIM_MAX_BOUNCES + 1):
+            rail_t, normal = self._cast_rails(origin, direction)
+            ball_t = _ray_circles(origin, direction, self.centers, 2 * radius) if len(self.centers) else np.empty(0)
+            hole_t = _ray_circles(origin, direction, self.holes, self.hole_radius) if len(self.holes) else np.empty(0)
+            first_ball = int(np.argmin(ball_t)) if len(ball_t) else -1
+            nearest_ball = ball_t[first_ball] if first_ball >= 0 else np.inf
+            nearest_hole = hole_t.min() if len(hole_t) else np.inf
+
+            t = min(rail_t, nearest_ball, nearest_hole, remaining)
+            origin = origin + direction * t
+            path.append(tuple(origin))
+            remaining -= t
+            if t == nearest_ball:
+                # Object ball leaves along the line of centers, cue ball keeps the tangential part
+                target = self.centers[first_ball]
+                line = (target - origin) / (2 * radius)
+                object_end = target + line * AIM_OBJECT_LENGTH
+                deflect = direction - line * (direction @ line)
+                path.append(tuple(origin + deflect * AIM_OBJECT_LENGTH / 2))
+                return path, tuple(origin), (tuple(target), tuple(object_end))
+            if t != rail_t or not np.isfinite(t):  # Pocketed or ran out of length
+                break
+            direction = direction - 2 * (direction @ normal) * normal
+        return path, None, None
+
+    def draw(self, screen):
+        if len(self.path) > 1:
+            pygame.draw.lines(screen, self.color, False, self.path, 1)
+        if self.ghost is not None:
+            pygame.draw.circle(screen, self.color, (int(self.ghost[0]), int(self.ghost[1])), 10, 1)
+            pygame.draw.line(screen, self.color, self.object_path[0], self.object_path[1], 1)
+
+FPS = 60
+NETWORK_EVENT = pygame.USEREVENT  # Posted by the netplay thread when an opponent message arrives
+GROUP_LABELS = {OPEN: '', SOLIDS: ' solids', STRIPES: ' stripes'}
+IDLE_FRAME_MS = 100  # Frame time while the table is at rest and nobody is aiming
+
+# Everything the renderer needs for one frame. Built from plain tuples, the simulation never touches it again.
+FrameSnapshot = namedtuple('FrameSnapshot', [
+    'frame', 'table_points', 'holes', 'balls', 'stick', 'trajectory',
+    'score_player1', 'score_player2', 'current_player', 'p', 'display_menu', 'input_time', 'cue_pos', 'placement',
+    'groups', 'winner', 'idle',
+])
+
+class SnapshotBuffer:
+    # Double buffer between the simulation and the renderer. The simulation fills the back slot and swaps,
+    # the renderer always takes the front (newest) one. A snapshot the renderer never saw hands its input
+    # timestamp on to the next one so latency samples aren't lost when frames are skipped.
     def __init__(self):
+        self.slots = [None, None]
+        self.front = 0
+        self.consumed = True
+        self.condition = threading.Condition()
+
+    def publish(self, snapshot):
+        with self.condition:
+            previous = self.slots[self.front]
+            if not self.consumed and previous is not None and previous.input_time is not None:
+                if snapshot.input_time is None or previous.input_time < snapshot.input_time:
+                    snapshot = snapshot._replace(input_time=previous.input_time)
+            back = 1 - self.front
+            self.slots[back] = snapshot
+            self.front = back
+            self.consumed = False
+            self.condition.notify()
+
+    def wait_newer(self, timeout):
+        # Newest snapshot the renderer hasn't drawn yet, or None after the timeout
+        with self.condition:
+            if self.consumed:
+                self.condition.wait(timeout)
+            if self.consumed:
+                return None
+            self.consumed = True
+            return self.slots[self.front]
+
+class FrameStats:
+    # Frame pacing and input latency samples, summarized as percentiles when the game exits
+    def __init__(self, size=3600):
+        self.frame_times = deque(maxlen=size)
+        self.idle_frame_times = deque(maxlen=size)  # Frames that slept on the idle throttle, kept out of the pacing numbers
+        self.latencies = deque(maxlen=size)
+        self.aim_latencies = deque(maxlen=size)
+        self.last_flip = None
+
+    def record_frame(self, snapshot, aim_time=None):
+        # Called right after the flip. input_time is when the frame's input was taken from pygame's queue,
+        # aim_time when the mouse was read again for the late aiming overlay.
+        now = time.perf_counter()
+        if self.last_flip is not None:
+            (self.idle_frame_times if snapshot.idle else self.frame_times).append(now - self.last_flip)
+        self.last_flip = now
+        if snapshot.input_time is not None:
+            self.latencies.append(now - snapshot.input_time)
+        if aim_time is not None:
+            self.aim_latencies.append(now - aim_time)
+
+    def report(self):
+        lines = []
+        for name, samples in (('frame time', self.frame_times), ('idle frame time', self.idle_frame_times),
+                              ('input latency', self.latencies), ('aim latency', self.aim_latencies)):
+            if not samples:
+                continue
+            ms = np.array(samples) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            lines.append(f"{name}: p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms, jitter (std) {ms.std():.2f} ms, n={len(ms)}")
+        return '\n'.join(lines)
+
+class Turtle_Pool:
+    def __init__(self, netplay=None, spectators=None, instrument=None):
         pygame.init()
         self.clock = pygame.time.Clock()
         
@@ -180,6 +721,20 @@ class Turtle_Pool:
         # Screen initialization
         self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT))
         pygame.display.set_caption("Turtle Pool")
+
+        # Lockstep multiplayer, None for local hot-seat play
+        self.netplay = netplay
+        self.shot_count = 0
+        self.rest_hashes = {}
+        self.remote_rest_hashes = {}
+        self.remote_inputs = deque()  # Opponent inputs waiting for our table to come to rest
+        if netplay is not None:
+            pygame.display.set_caption(f"Turtle Pool - Player {netplay.player}")
+            # An idle loop sleeps in pygame.event.wait, a message from the opponent has to wake it
+            netplay.on_message = lambda: pygame.event.post(pygame.event.Event(NETWORK_EVENT))
+
+        # Optional broadcast of the live table to spectators
+        self.spectators = spectators
         
         # State
         self.init_game_state()
@@ -196,8 +751,20 @@ class Turtle_Pool:
         self.p = 0.0
         self.direction = 1
         self.delta_p = 0.001
+        self.events = EventRing()
+        self.undo_stack = deque(maxlen=UNDO_LIMIT)  # (player, GameState) from before each shot, placement and rack
         self.polygon_surface = pygame.Surface((self.WIDTH, self.HEIGHT), pygame.SRCALPHA)  # Ensure it supports transparency
         self.last_click_time = 0
+        self.ball_was_moving = False
+        self.input_applied = False  # An input changed the simulation this frame, see _stayed_idle
+        self.throttled = False  # This frame slept on the idle timeout instead of the 60 Hz schedule
+        self.display_menu = False
+
+        # Input recording for replays, see start_recording
+        self.recording = False
+        self.replay = None
+        self.record_origin = 0
+        self._recorded_stick = None
         self.is_dragging = False
         self.drag_start = Vector2(0, 0)
         self.FRICTION = 0.98
@@ -207,20 +774,27 @@ class Turtle_Pool:
 
         # Pool stick
         self.pool_stick = PoolStick()
+        self.trajectory = TrajectoryPreview()
+        self.ball_in_hand = BallInHand()
+        self.placing = False
 
         # Setup pool balls
         self.setup_balls()
 
         # Create 7 holes
         self.holes = self.generate_holes(14)
+        self.cushion_points = []
+        self.cushion_segments = []
+        self.update_table(self.p)
 
-        # Start sound engine
-        self.midi_instrument = MidiInstrument()
+        # Start sound engine, headless tools pass a SilentInstrument
+        self.midi_instrument = instrument if instrument is not None else MidiInstrument()
         
         # Fonts
         self.font_big = pygame.font.SysFont(None, 50)
         self.font_medium = pygame.font.SysFont(None, 40)
         self.font_small = pygame.font.SysFont(None, 36)
+        self.button_rects = {}
         
         # Colors
         self.color_red = (255, 0, 0)
@@ -232,11 +806,25 @@ class Turtle_Pool:
         # Buttons
         self.rerack_text = self.font_medium.render('Re-Rack', True, self.color_white)
         self.endturn_text = self.font_medium.render('Change-Player', True, self.color_white)
+        self._layout_buttons()
+
+        # Reused to draw snapshots with the normal drawing code
+        self._render_ball = Ball(Vector2(0, 0), self.WHITE)
+        self._render_stick = PoolStick()
+        self._render_trajectory = TrajectoryPreview()
+
+        self.stats = FrameStats()
+        self.sim_inputs = None  # Queue feeding the simulation thread in pipelined mode
+        self.menu_actions = []  # Menu clicks waiting for the next frame in serial mode
         
     def init_game_state(self):
         self.current_player = 1
         self.score_player1 = 0
         self.score_player2 = 0
+        self.groups = [OPEN, OPEN]  # Each player's group, decided by the first legal pocket after the break
+        self.winner = 0
+        self.is_break = True
+        self.shot = None  # Summary of the shot in play, evaluated by the rules once the table rests
 
     def setup_balls(self):
         self.init_game_state()
@@ -284,6 +872,8 @@ class Turtle_Pool:
                 else:
                     color = solid_colors[order[ball_idx] % 7]
                     is_striped = order[ball_idx] >= 7
+                # Numbered 1-7 solids, 8 black, 9-15 stripes (order value 7 is the first stripe, 8 the black ball)
+                number = 9 if order[ball_idx] == 7 else 8 if order[ball_idx] == 8 else order[ball_idx] + 1
                     
                 x = start_x + col * spacing - (row-1) * spacing / 2
                 y = start_y + (row-1) * spacing
@@ -291,18 +881,200 @@ class Turtle_Pool:
                 # Rotate each ball's position around the screen's center
                 x, y = self.rotate_point(x, y, self.rotation_angle, screen_center_x, screen_center_y)
 
-                self.balls.append(Ball(Vector2(x, y), color, is_striped))
+                self.balls.append(Ball(Vector2(x, y), color, is_striped, number))
                 ball_idx += 1
 
     def switch_player(self):
         self.current_player = 3 - self.current_player  # switches between 1 and 2
 
+    def export_state(self):
+        # Everything the simulation depends on as plain JSON-friendly values, used to resync a network opponent
+        return GameState.capture(self).to_dict()
+
+    def import_state(self, state):
+        GameState.from_dict(state).restore(self)
+        # The history led up to the table that was just replaced, after a resync the peers' stacks would differ
+        self.undo_stack.clear()
+        if self.recording:
+            self._record('state', state)
+
+    def get_state_hash(self):
+        return GameState.capture(self).hash()
+
+    def is_local_turn(self):
+        return self.netplay is None or self.current_player == self.netplay.player
+
+    def can_undo(self):
+        # In a network game only the player who made the last input may take it back. After a miss the turn has
+        # passed to the opponent, but the shot is still the shooter's.
+        if not self.undo_stack:
+            return False
+        return self.netplay is None or self.undo_stack[-1][0] == self.netplay.player
+
+    def send_input(self, kind, **data):
+        # Every change a player makes to the simulation goes through here so the opponent can replay it.
+        # The p phase and a hash of the state the input was applied to travel with it.
+        if self.netplay is not None:
+            # No frame number travels with an input, only a table at rest looks the same on both peers
+            if self.ball_was_moving:
+                return
+            self.netplay.send(dict(data, type=kind, p=self.p, direction=self.direction, hash=self.get_state_hash()))
+        self._apply_input(kind, data)
+
+    def _apply_input(self, kind, data):
+        self.input_applied = True
+        if kind == 'undo':
+            # Recorded as the state it went back to, a replay started part way through has no undo history
+            if self.undo_stack:
+                self.undo_stack.pop()[1].restore(self)
+                if self.recording:
+                    self._record('state', self.export_state())
+            return
+        if self.recording:
+            self._record(kind, dict(data))
+        if kind in ('shot', 'place', 'rerack'):
+            # Only the player whose turn it is can send these, so they made this input
+            self.undo_stack.append((self.current_player, GameState.capture(self)))
+        if kind == 'shot':
+            self.cue_ball.vel = Vector2(data['vel'])
+            self.shot_count += 1
+            self.shot = new_shot(ball_mask(ball.number for ball in self.balls), self.groups[self.current_player - 1],
+                                 self.is_break)
+            self.is_break = False
+        elif kind == 'place':
+            # Snap against the cushion at the input's p, not whatever p this peer last built the table at
+            self.update_table(self.p)
+            pos = self.ball_in_hand.snap(self, data['pos'], self.cue_ball)
+            if pos is not None:
+                self.cue_ball.pos = pos
+        elif kind == 'rotate':
+            self.rotation_angle += np.pi / 6
+            self.adjust_balls_after_rotation()
+        elif kind == 'flip_x':
+            self.flip_x = not self.flip_x
+        elif kind == 'flip_y':
+            self.flip_y = not self.flip_y
+        elif kind == 'rerack':
+            self.setup_balls()
+        elif kind == 'switch_player':
+            self.current_player = 2 if self.current_player == 1 else 1
+
+    def start_recording(self):
+        # Replays are the starting state plus every input with the frame it landed on, the simulation is
+        # deterministic so that is enough to play the game back
+        self.recording = True
+        self.record_origin = self.events.frame
+        self._recorded_stick = None
+        self.replay = {'version': 1, 'start': self.export_state(), 'inputs': [], 'advances': []}
+
+    def save_replay(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.replay, file, separators=(',', ':'))
+
+    def _record(self, kind, data):
+        self.replay['inputs'].append([self.events.frame - self.record_origin, kind, data, self.p, self.direction])
+
+    def _record_stick(self):
+        # The stick doesn't change the simulation but makes replays readable, recorded only when it changes
+        state = self.get_stick_state()
+        if state != self._recorded_stick:
+            self._recorded_stick = state
+            self._record('stick', state)
+
+    def get_stick_state(self):
+        stick = self.pool_stick
+        if not stick.is_visible:  # Where a hidden stick sits doesn't matter, keep it from spamming the recording
+            return [False, [0, 0], [0, 0]]
+        return [True, list(stick.start_position), list(stick.end_position)]
+
+    def set_stick_state(self, state):
+        visible, start, end = state
+        self.pool_stick.is_visible = visible
+        self.pool_stick.set_start_position(start)
+        self.pool_stick.set_end_position(end)
+        if visible:
+            self.trajectory.update(self, self.cue_ball, Vector2(start) - Vector2(end))
+
+    def replay_frame(self, entries, steps=1):
+        # Plays one recorded frame: its inputs, the physics step and the p morph. Returns what to draw.
+        for kind, data, p, direction in entries:
+            if kind == 'state':
+                self.import_state(data)
+            elif kind == 'stick':
+                self.set_stick_state(data)
+            else:
+                self.p, self.direction = p, direction
+                self._apply_input(kind, data)
+        self.simulate_frame()
+        snapshot = self.take_snapshot()
+        self.advance_p(steps)
+        return snapshot
+
+    def process_network_messages(self):
+        if self.netplay is None:
+            return
+        for message in self.netplay.poll():
+            kind = message.pop('type', None)
+            if kind == 'connect':
+                if self.netplay.player == 1:  # The host's table is the starting point for both
+                    self.netplay.send({'type': 'state', 'state': self.export_state()})
+            elif kind == 'disconnect':
+                # Opponent left, carry on as a local game
+                self.netplay.close()
+                self.netplay = None
+                pygame.display.set_caption("Turtle Pool")
+                return
+            elif kind == 'resync':
+                self.netplay.send({'type': 'state', 'state': self.export_state()})
+            elif kind == 'state':
+                self.import_state(message['state'])
+            elif kind == 'rest':
+                self.remote_rest_hashes[message['seq']] = message['hash']
+                self._check_rest_hash(message['seq'])
+            else:
+                self.remote_inputs.append((kind, message))
+
+        # The opponent only sends inputs with their table at rest (see send_input). Ours may still be rolling
+        # the last shot, the input has to wait for the same resting table or the two peers drift apart.
+        while self.remote_inputs and not self.ball_was_moving:
+            kind, message = self.remote_inputs.popleft()
+            self.p = message.pop('p')
+            self.direction = message.pop('direction')
+            desynced = message.pop('hash') != self.get_state_hash()
+            self._apply_input(kind, message)
+            if desynced:
+                self._resync()
+            if kind == 'shot':  # Anything after it was sent once this shot had stopped
+                break
+
+    def _on_table_rest(self):
+        # Both clients reach rest after the same number of steps, so their hashes must match here
+        if self.netplay is None:
+            return
+        self.rest_hashes[self.shot_count] = self.get_state_hash()
+        self.netplay.send({'type': 'rest', 'seq': self.shot_count, 'hash': self.rest_hashes[self.shot_count]})
+        self._check_rest_hash(self.shot_count)
+
+    def _check_rest_hash(self, seq):
+        if seq not in self.rest_hashes or seq not in self.remote_rest_hashes:
+            return
+        local_hash = self.rest_hashes.pop(seq)
+        remote_hash = self.remote_rest_hashes.pop(seq)
+        if local_hash != remote_hash:
+            self._resync()
+
+    def _resync(self):
+        # The host's table is authoritative, it pushes its state or the client asks for it
+        if self.netplay.player == 1:
+            self.netplay.send({'type': 'state', 'state': self.export_state()})
+        else:
+            self.netplay.send({'type': 'resync'})
+
     def get_free_position(self):
-        """Get a free position at the center of the table that doesn't overlap with other balls."""
+        """Get a free position as close to the center as possible, on the table and clear of other balls."""
         center_pos = Vector2(self.WIDTH / 2, self.HEIGHT / 2)
-        while any(ball.pos.distance_to(center_pos) < 2 * ball.radius for ball in self.balls):
-            center_pos += Vector2(5, 5)  # Adjust the position slightly
-        return center_pos
+        pos = self.ball_in_hand.snap(self, center_pos, self.cue_ball)
+        return pos if pos is not None else center_pos
     
     def generate_holes(self, num_holes):
         # This function generates holes spread around the polygon
@@ -403,39 +1175,38 @@ class Turtle_Pool:
         return x_coords, y_coords
     
     def draw_polygon(self, p=0.5): # draws the pool table, p is the transformation normal
-        x, y = self.f(p)
-        
-        for i in range(len(x)):
-            if self.flip_x:
-                x[i] = -x[i]
-            if self.flip_y:
-                y[i] = -y[i]
-            x[i], y[i] = self.rotate_point(x[i], y[i], self.rotation_angle, 0, 0)
-        
-        normalized_x = (x - x.min()) / (x.max() - x.min()) * (self.WIDTH - 40) + 20
-        normalized_y = (y - y.min()) / (y.max() - y.min()) * (self.HEIGHT - 40) + 20
-        
-        points = list(zip(normalized_x, normalized_y))
+        points = self.update_table(p)
+        self.draw_table(points, self.holes)
+        return points
+
+    def update_table(self, p):
+        # Table outline and pockets for this frame, the geometry the physics step collides against
+        x, y = self.get_polygon_points(p)
+        points = list(zip(x.tolist(), y.tolist()))
         self.current_table_points = points
         self.holes = self.generate_holes_from_points(points, 7)
-        
+
+        # Where ball centres may be, shared by the rails, the aim preview, placement and re-seating.
+        # Built once per frame instead of once per ball.
+        self.cushion_points = cushion_polygon(points, self.cue_ball.radius)
+        self.cushion_segments = cushion_segments(self.cushion_points)
+        return points
+
+    def draw_table(self, points, holes):
         pygame.draw.polygon(self.screen, self.GREEN, points)
         self.draw_wooden_edge(self.screen, points)
 
         # Draw the holes
-        for hole in self.holes:
+        for hole in holes:
             hole.draw(self.screen)
-
-        return points
     
     def get_polygon_points(self, p):
         x, y = self.f(p)
-        for i in range(len(x)):
-            if self.flip_x:
-                x[i] = -x[i]
-            if self.flip_y:
-                y[i] = -y[i]
-            x[i], y[i] = self.rotate_point(x[i], y[i], self.rotation_angle, 0, 0)
+        if self.flip_x:
+            x = -x
+        if self.flip_y:
+            y = -y
+        x, y = self.rotate_point(x, y, self.rotation_angle, 0, 0)
         
         normalized_x = (x - x.min()) / (x.max() - x.min()) * (self.WIDTH - 40) + 20
         normalized_y = (y - y.min()) / (y.max() - y.min()) * (self.HEIGHT - 40) + 20
@@ -484,69 +1255,105 @@ class Turtle_Pool:
                 # Impart momentum to the ball
                 ball.vel += move_direction * 2  # Adjust the multiplier for desired momentum
 
-    def handle_ball_polygon_collision(self, ball): # Table edges
-        polygon_points = list(zip(*self.get_polygon_points(self.p)))
-        for i in range(len(polygon_points)):
-            segment_start = Vector2(polygon_points[i])
-            segment_end = Vector2(polygon_points[(i + 1) % len(polygon_points)])
-
-            if self.collides_with_segment(ball.pos, ball.radius, segment_start, segment_end):
-                segment_normal = (segment_end - segment_start).rotate(90).normalize()
-                reflection = 2 * ball.vel.dot(segment_normal) * segment_normal
-                
-                ball.vel -= reflection
-
-                # Ensure the ball is outside of the segment after reflection.
-                while self.collides_with_segment(ball.pos, ball.radius, segment_start, segment_end):
-                    ball.pos += segment_normal
-                return True
+    def handle_ball_polygon_collision(self, ball): # Table edges, a point test against the cushion built by update_table
+        # Returns True when the ball bounced off a rail
+        pos, vel = ball.pos, ball.vel
+        if self.point_inside_polygon((pos.x, pos.y), self.cushion_points):
+            return False
+        x, y, nx, ny = self.nearest_cushion_point(pos.x, pos.y)
+        pos.update(x, y)
+        # Only a ball heading into the rail bounces, one the morphing table ran into is just pushed along.
+        # Only the bounce counts as reaching the rail, the rules must not see a resting ball against a moving cushion.
+        along = vel.x * nx + vel.y * ny
+        if along >= 0:
+            return False
+        vel.x -= 2 * along * nx
+        vel.y -= 2 * along * ny
+        return True
+
+    def nearest_cushion_point(self, x, y):
+        # Closest point just inside the cushion and the inward normal there
+        segments = self.cushion_segments
+        best_sq = math.inf
+        for i, (sx, sy, dx, dy, inv_length_sq, nx, ny) in enumerate(segments):
+            t = ((x - sx) * dx + (y - sy) * dy) * inv_length_sq
+            t = 0.0 if t < 0 else 1.0 if t > 1 else t
+            cx, cy = sx + t * dx, sy + t * dy
+            distance_sq = (cx - x) * (cx - x) + (cy - y) * (cy - y)
+            if distance_sq < best_sq:
+                best_sq, best, best_t = distance_sq, (cx, cy, nx, ny), (i, t)
+        cx, cy, nx, ny = best
+        i, t = best_t
+        if t == 0.0 or t == 1.0:
+            # On a corner, step off it along the bisector so the point ends up inside both rails
+            other = segments[i - 1] if t == 0.0 else segments[(i + 1) % len(segments)]
+            nx, ny = nx + other[5], ny + other[6]
+            length = math.hypot(nx, ny)
+            nx, ny = nx / length, ny / length
+        return cx + nx * CUSHION_CLEARANCE, cy + ny * CUSHION_CLEARANCE, nx, ny
+
+    def seat_ball(self, pos):
+        # Moves a point that is off the cushion back onto the table, in place
+        if not self.point_inside_polygon((pos.x, pos.y), self.cushion_points):
+            pos.update(self.nearest_cushion_point(pos.x, pos.y)[:2])
+        return pos
 
     def handle_ball_collision(self, ball1, ball2):
-        # Check for collision between two balls
-        distance = ball1.pos.distance_to(ball2.pos)
-        if distance < ball1.radius + ball2.radius:
+        # Check for collision between two balls, all in plain floats since this runs for every pair every frame
+        pos1, pos2, vel1, vel2 = ball1.pos, ball2.pos, ball1.vel, ball2.vel
+        dx = pos1.x - pos2.x
+        dy = pos1.y - pos2.y
+        reach = ball1.radius + ball2.radius
+        distance_sq = dx * dx + dy * dy
+        if distance_sq < reach * reach:
+            distance = math.sqrt(distance_sq)
             
             # Push the balls out of each other to avoid overlap
-            overlap = (ball1.radius + ball2.radius) - distance
-            direction = (ball1.pos - ball2.pos).normalize()
-            ball1.pos += direction * (overlap / 2)
-            ball2.pos -= direction * (overlap / 2)
-
-            # Calculate the normal and tangent vectors
-            normal = direction
-            tangent = Vector2(normal.y, -normal.x)
-
-            # Calculate the velocity components along the normal and tangent
-            v1n = ball1.vel.dot(normal)
-            v1t = ball1.vel.dot(tangent)
-            v2n = ball2.vel.dot(normal)
-            v2t = ball2.vel.dot(tangent)
+            overlap = reach - distance
+            nx, ny = (dx / distance, dy / distance) if distance else (1.0, 0.0)
+            pos1.x += nx * overlap / 2
+            pos1.y += ny * overlap / 2
+            pos2.x -= nx * overlap / 2
+            pos2.y -= ny * overlap / 2
+
+            # Calculate the velocity components along the normal and the tangent (ny, -nx)
+            v1n = vel1.x * nx + vel1.y * ny
+            v1t = vel1.x * ny - vel1.y * nx
+            v2n = vel2.x * nx + vel2.y * ny
+            v2t = vel2.x * ny - vel2.y * nx
 
             # Use the conservation of momentum to calculate the new velocities along the normal
             v1n_new = v1n * (ball1.radius - ball2.radius) / (ball1.radius + ball2.radius) + v2n * 2 * ball2.radius / (ball1.radius + ball2.radius)
             v2n_new = v2n * (ball2.radius - ball1.radius) / (ball1.radius + ball2.radius) + v1n * 2 * ball1.radius / (ball1.radius + ball2.radius)
 
             # Update the velocities using the new normal velocities and the unchanged tangent velocities
-            ball1.vel = v1n_new * normal + v1t * tangent
-            ball2.vel = v2n_new * normal + v2t * tangent
+            vel1.update(v1n_new * nx + v1t * ny, v1n_new * ny - v1t * nx)
+            vel2.update(v2n_new * nx + v2t * ny, v2n_new * ny - v2t * nx)
             return True
 
-    def draw_score(self):
-        self._display_player_scores()
-        self._display_p_value()
+    def draw_score(self, snapshot):
+        self._display_player_scores(snapshot.score_player1, snapshot.score_player2, snapshot.current_player,
+                                    snapshot.groups, snapshot.winner)
+        self._display_p_value(snapshot.p)
         
-        if self.display_menu:
-            self._display_button('Re-Rack', self.setup_balls, y_position=10)
+        if snapshot.display_menu:
+            self._display_button('Re-Rack', self._rerack, y_position=10)
             self._display_button('Change-Player', self._toggle_player, y_position=70)
             self._display_instrument_button()
         
-    def _display_player_scores(self):
-        active_font, inactive_font = (self.font_big, self.font_small) if self.current_player == 1 else (self.font_small, self.font_big)
-        self.screen.blit(active_font.render(f'Player 1: {self.score_player1}', True, self.color_red), (self.WIDTH - 250, 10))
-        self.screen.blit(inactive_font.render(f'Player 2: {self.score_player2}', True, self.color_blue), (self.WIDTH - 230, 60))
+    def _display_player_scores(self, score_player1, score_player2, current_player, groups, winner):
+        active_font, inactive_font = (self.font_big, self.font_small) if current_player == 1 else (self.font_small, self.font_big)
+        label1, label2 = (GROUP_LABELS[group] for group in groups)
+        text1 = active_font.render(f'Player 1: {score_player1}{label1}', True, self.color_red)
+        text2 = inactive_font.render(f'Player 2: {score_player2}{label2}', True, self.color_blue)
+        # Kept on screen once a group name makes the line longer
+        self.screen.blit(text1, (min(self.WIDTH - 250, self.WIDTH - 10 - text1.get_width()), 10))
+        self.screen.blit(text2, (min(self.WIDTH - 230, self.WIDTH - 10 - text2.get_width()), 60))
+        if winner:
+            self.screen.blit(self.font_medium.render(f'Player {winner} wins!', True, self.color_green), (self.WIDTH - 250, 110))
     
-    def _display_p_value(self):
-        p_text = f"P = {str(int(self.p*100)/100).replace('.', '.')}"
+    def _display_p_value(self, p):
+        p_text = f"P = {str(int(p*100)/100).replace('.', '.')}"
         p_text_surface = self.font_small.render(p_text, True, self.color_green)
         p_position = (self.WIDTH - (self.WIDTH//7), self.HEIGHT - p_text_surface.get_height() -  (self.WIDTH//32))
         self.screen.blit(p_text_surface, p_position)
@@ -578,6 +1385,7 @@ class Turtle_Pool:
         self.screen.blit(text_render, (button_x + 10, button_y + 5))
         
         # Check clicks on the left "<" section of the button for instrument down
+        self._layout_buttons()  # The instrument name, and with it the button width, may have changed
         if self._check_button_click(button_x, button_y, text_width // 3, button_height, self.midi_instrument.instrument_down):
             return
 
@@ -592,60 +1400,50 @@ class Turtle_Pool:
         if x <= mouse[0] <= x + width and y <= mouse[1] <= y + height:
             for button in buttons:
                 if click[button - 1] and current_time - self.last_click_time > 500:  # 500 milliseconds cooldown
-                    action()
+                    self.submit(action)
                     self.last_click_time = current_time
                     return True  # Indicate that the button was clicked
         return False
 
-    def _is_click_on_button(self, mouse_pos):
-        # List to store button dimensions and positions
-        buttons = []
-
-        # Re-Rack button
-        button_font = self.font_medium
-        text_render = button_font.render('Re-Rack', True, self.color_white)
-        text_width, text_height = text_render.get_size()
-        button_width = text_width + 20
-        button_height = text_height + 10
-        button_x = (self.WIDTH - button_width) // 2
-        buttons.append({'x': button_x, 'y': 10, 'width': button_width, 'height': button_height})
-
-        # Change-Player button
-        text_render = button_font.render('Change-Player', True, self.color_white)
-        text_width, text_height = text_render.get_size()
-        button_width = text_width + 20
-        button_height = text_height + 10
-        button_x = (self.WIDTH - button_width) // 2
-        buttons.append({'x': button_x, 'y': 70, 'width': button_width, 'height': button_height})
-
-        # Instrument button (covers the full width for both < and >)
-        instr_name = GM_INSTRUMENTS[self.midi_instrument.instrument]
-        instr_text = f'< {instr_name} >'
-        text_render = self.font_medium.render(instr_text, True, self.color_white)
-        text_width, text_height = text_render.get_size()
-        button_width = text_width + 20
-        button_height = text_height + 10
-        button_x = (self.WIDTH - button_width) // 2
-        buttons.append({'x': button_x, 'y': 130, 'width': button_width, 'height': button_height})
+    def _layout_buttons(self):
+        # Menu button rectangles, measured on the drawing side so input handling never has to render text
+        rects = []
+        for text, y in (('Re-Rack', 10), ('Change-Player', 70), (f'< {GM_INSTRUMENTS[self.midi_instrument.instrument]} >', 130)):
+            text_width, text_height = self.font_medium.size(text)
+            button_width = text_width + 20
+            button_height = text_height + 10
+            rects.append(((self.WIDTH - button_width) // 2, y, button_width, button_height))
+        self.button_rects = rects
 
+    def _is_click_on_button(self, mouse_pos):
         # Check if mouse_pos is within any of the button regions
-        for button in buttons:
-            if button['x'] <= mouse_pos[0] <= button['x'] + button['width'] and button['y'] <= mouse_pos[1] <= button['y'] + button['height']:
+        for x, y, width, height in self.button_rects:
+            if x <= mouse_pos[0] <= x + width and y <= mouse_pos[1] <= y + height:
                 return True
                 
         return False
 
+    def submit(self, action):
+        # Menu actions come from the drawing code, after this frame's simulation and before p advances. They wait
+        # for the start of the next frame like any other input, so the input (and a replay of it) carries the p
+        # that frame is simulated with. In pipelined mode they also have to run on the simulation thread.
+        if self.sim_inputs is None:
+            self.menu_actions.append(action)
+        else:
+            self.sim_inputs.put((time.perf_counter(), action))
+
+    def _rerack(self):
+        if self.is_local_turn():
+            self.send_input('rerack')
+
     def _toggle_player(self):
-        self.current_player = 2 if self.current_player == 1 else 1
+        if self.is_local_turn():
+            self.send_input('switch_player')
                     
     def handle_ball_drag(self, event, ball):
-        cue_ball_stopped = ball.vel == Vector2(0, 0)
-        
-        # Check if mouse click is on any button:
-        mouse_pos = pygame.mouse.get_pos()
-        is_on_button = self._is_click_on_button(mouse_pos)
-
-        if event.type == pygame.MOUSEBUTTONDOWN and not is_on_button:
+        if not self.is_local_turn():  # Opponent's shot, their inputs arrive over the network
+            return
+        if event.type == pygame.MOUSEBUTTONDOWN and not self._is_click_on_button(pygame.mouse.get_pos()):
             if event.button == 1:  # Left click
                 self.is_dragging = True
                 self.drag_start = ball.pos
@@ -656,22 +1454,30 @@ class Turtle_Pool:
                 self.pool_stick.is_visible = False
                 self.is_dragging = False
                 
-            elif event.button == 2:  # Middle mouse button
-                self.cue_ball.pos = Vector2(event.pos)
+            elif event.button == 2:  # Middle mouse button, shows where the cue ball would go until released
+                self.placing = True
+                self.ball_in_hand.update_preview(self, event.pos)
 
         elif event.type == pygame.MOUSEBUTTONUP:
-            if event.button == 1 and self.is_dragging:  # Left click
+            if event.button == 2 and self.placing:
+                self.placing = False
+                self.send_input('place', pos=list(event.pos))
+            elif event.button == 1 and self.is_dragging:  # Left click
                 drag_end = Vector2(pygame.mouse.get_pos())
-                ball.vel = (self.drag_start - drag_end) * 0.1  # Adjust this for different shot power
+                shot = (self.drag_start - drag_end) * 0.1  # Adjust this for different shot power
+                self.send_input('shot', vel=[shot.x, shot.y])
                 self.pool_stick.is_visible = False
                 self.is_dragging = False
 
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_w:
-                self.cue_ball.pos = Vector2(pygame.mouse.get_pos())
+                self.send_input('place', pos=list(pygame.mouse.get_pos()))
 
-        elif self.is_dragging:  
+        elif event.type == MOUSEMOTION and self.is_dragging:
             self.update_pool_stick_position(event.pos, ball)
+
+        elif event.type == MOUSEMOTION and self.placing:
+            self.ball_in_hand.update_preview(self, event.pos)
                 
     def trigger_hit_event(self, ball):
         drag_end = self.pool_stick.get_end_position()
@@ -680,14 +1486,27 @@ class Turtle_Pool:
         self.is_dragging = False
     
     def update_pool_stick_position(self, event_pos, ball):
-        # Current drag position
-        current_drag_pos = Vector2(event_pos)
+        aim = self.aim_stick(ball.pos, event_pos)
+        if aim is None:  # No direction to aim in
+            return
+        start, end, direction = aim
+        self.pool_stick.set_start_position(start)
+        self.pool_stick.set_end_position(end)
+
+        # The shot goes away from the mouse
+        self.trajectory.update(self, ball, -direction)
+
+    def aim_stick(self, ball_pos, mouse_pos):
+        # Stick start, end and aim direction for the ball at ball_pos and the mouse at mouse_pos
+        current_drag_pos = Vector2(mouse_pos)
+        if current_drag_pos == ball_pos:
+            return None
         
         # Calculate direction from the current drag position to the ball
-        direction = (current_drag_pos - ball.pos).normalize()
+        direction = (current_drag_pos - ball_pos).normalize()
 
         # Calculate distance between ball and current_drag_pos
-        drag_distance = ball.pos.distance_to(current_drag_pos)
+        drag_distance = ball_pos.distance_to(current_drag_pos)
 
         # Calculate the offset based on the drag distance and direction
         offset_distance = min(MAX_OFFSET, drag_distance)
@@ -698,35 +1517,14 @@ class Turtle_Pool:
             drag_distance = MAX_STICK_LENGTH
 
         # Calculate the capped drag_end position
-        capped_drag_end = ball.pos + direction * drag_distance
-        
-        # Apply random drift using numpy for style
-        drift_offset = Vector2(np.random.uniform(-STICK_DRIFT, STICK_DRIFT), np.random.uniform(-STICK_DRIFT, STICK_DRIFT))
-        drifted_drag_end = capped_drag_end + drift_offset
+        capped_drag_end = ball_pos + direction * drag_distance
         
-        # Set the stick's positions with the offset
-        self.pool_stick.set_start_position(ball.pos + offset_vector)
-        self.pool_stick.set_end_position(drifted_drag_end + offset_vector)
-      
-    def get_polygon_centroid(self, polygon):
-        centroid = Vector2(0, 0)
-        n = len(polygon)
-        for point in polygon:
-            centroid.x += point[0]
-            centroid.y += point[1]
-        centroid.x /= n
-        centroid.y /= n
-        return centroid
+        # The stick's positions with the offset
+        return ball_pos + offset_vector, capped_drag_end + offset_vector, direction
     
     def adjust_balls_after_rotation(self):
-        # Calculate the centroid of the current table
-        table_centroid = self.get_polygon_centroid(self.current_table_points)
-        
-        # Get bounding box of current table for quick checks
-        table_bbox = np.array([
-            [min(pt[0] for pt in self.current_table_points), min(pt[1] for pt in self.current_table_points)],
-            [max(pt[0] for pt in self.current_table_points), max(pt[1] for pt in self.current_table_points)]
-        ])
+        # Cushion of the rotated table, the balls are re-seated on it
+        self.update_table(self.p)
         
         rotation_matrix = np.array([
             [np.cos(np.pi / 6), -np.sin(np.pi / 6)],
@@ -737,151 +1535,401 @@ class Turtle_Pool:
             # Rotate ball positions
             ball.pos.x, ball.pos.y = np.dot(rotation_matrix, [ball.pos.x - self.WIDTH / 2, ball.pos.y - self.HEIGHT / 2]) + [self.WIDTH / 2, self.HEIGHT / 2]
             
-            # Quick bounding box check before point-in-polygon check
-            if not (table_bbox[0][0] <= ball.pos.x <= table_bbox[1][0] and table_bbox[0][1] <= ball.pos.y <= table_bbox[1][1]):
-                is_inside = False
-            else:
-                is_inside = self.point_inside_polygon([ball.pos.x, ball.pos.y], self.current_table_points)
-            
-            # If ball is outside table, adjust its position
-            while not is_inside:
-                # Move ball towards the centroid of the table
-                direction_to_centroid = table_centroid - ball.pos
-                direction_to_centroid = direction_to_centroid.normalize()  # Get unit vector towards centroid
-                ball.pos += direction_to_centroid
-                
-                # Check again with bounding box and then point-in-polygon
-                if not (table_bbox[0][0] <= ball.pos.x <= table_bbox[1][0] and table_bbox[0][1] <= ball.pos.y <= table_bbox[1][1]):
-                    is_inside = False
-                else:
-                    is_inside = self.point_inside_polygon([ball.pos.x, ball.pos.y], self.current_table_points)
+            # If ball is outside table, put it back at the nearest spot on it
+            self.seat_ball(ball.pos)
             
             # Rotate ball velocities to adjust trajectories
             ball.vel.x, ball.vel.y = np.dot(rotation_matrix, [ball.vel.x, ball.vel.y])
             
-    def run(self):
-        running = True
+    def run(self, pipelined=False, report_stats=False):
         self.ball_was_moving = False
-        self.player_scored = False
         self.display_menu = False
         self.mouse_button_up  = False
         self.player_shots = 3 # need to do something with this still
+        if pipelined:
+            self._run_pipelined()
+        else:
+            self._run_serial()
+        if report_stats:
+            print(self.stats.report())
+        if self.netplay is not None:
+            self.netplay.close()
+        if self.spectators is not None:
+            self.spectators.close()
+        pygame.quit()
+
+    def _run_serial(self):
+        # Input, simulation, drawing and flip one after the other on this thread
+        running = True
         while running:
             try:
-                self.screen.fill(self.WHITE) # fill the background whatever color
-                polygon_points = self.draw_polygon(self.p) # draw the board
+                # Nothing is moving and nobody is aiming, sleep until input arrives or the next slow morph step
+                idle = self.throttled = not self.ball_was_moving and not self.is_dragging
+                events = self.wait_for_events(IDLE_FRAME_MS) if idle else pygame.event.get()
+                input_time = time.perf_counter() if events else None
+
+                for event in events:
+                    if not self.handle_event(event):
+                        running = False
+                actions, self.menu_actions = self.menu_actions, []
+                for action in actions:
+                    action()
 
+                self.simulate_frame()
+                idle = self._stayed_idle(idle)
+                snapshot = self.take_snapshot(input_time)
+                late_aim = self.is_dragging and self.pool_stick.is_visible
+                self.render_snapshot(snapshot, late_aim)
+                aim_time = self.draw_late_aim(snapshot) if late_aim else None
+                pygame.display.flip()
+                self.stats.record_frame(snapshot, aim_time)
+
+                if self.spectators is not None:
+                    self.spectators.publish(self)
+
+                elapsed = self.clock.tick(FPS)
+                # While idle the morph keeps its usual speed, it just advances in fewer, larger steps
+                self.advance_p(max(1, round(elapsed * FPS / 1000)) if idle else 1)
+            except:
+                pass
+
+    def _run_pipelined(self):
+        # The simulation runs on its own thread and publishes snapshots, this thread pumps input and draws
+        # the newest snapshot, so frame N is on screen while frame N+1 is being simulated.
+        self.sim_inputs = queue.Queue()
+        self.snapshot_buffer = SnapshotBuffer()
+        self.sim_running = True
+        simulation = threading.Thread(target=self._simulation_loop, daemon=True)
+        simulation.start()
+
+        running = True
+        while running:
+            try:
                 for event in pygame.event.get():
                     if event.type == QUIT:
                         running = False
-                    elif event.type == KEYDOWN:
-                        if event.key == pygame.K_UP:
-                            self.midi_instrument.note_up()
-                        elif event.key == pygame.K_DOWN:
-                            self.midi_instrument.note_down()
-                        elif event.key == pygame.K_LEFT:
-                            self.midi_instrument.instrument_down()
-                        elif event.key == pygame.K_RIGHT:
-                            self.midi_instrument.instrument_up()
-                        elif event.key == pygame.K_r:
-                            self.rotation_angle += np.pi / 6
-                            self.adjust_balls_after_rotation()
-                        elif event.key == pygame.K_q:
-                            self.flip_x = not self.flip_x
-                        elif event.key == pygame.K_e:
-                            self.flip_y = not self.flip_y
-                        elif event.key == pygame.K_ESCAPE:
-                            self.display_menu = not self.display_menu
-                    if event.type == MOUSEBUTTONDOWN:
-                        self.mouse_button_up  = True
-                    elif event.type == MOUSEBUTTONUP:
-                        self.mouse_button_up  = False
-
-                # Before processing all balls, assume all have stopped
-                all_balls_stopped = True
-
-                # Start by iterating through all balls
-                for i, ball in enumerate(self.balls):
-                    # Move the ball and handle ball-polygon collision
-                    self.move_ball(ball)
-                    self.handle_ball_polygon_collision(ball)  # wall collide
-                    ball.draw(self.screen)
-
-                    # If any ball is moving, set the flag to False
-                    if ball.vel != Vector2(0, 0):
-                        all_balls_stopped = False
-                        
-                    # Handle ball-hole collision
-                    for hole in self.holes:
-                        hole.draw(self.screen)
-                        if ball.pos.distance_to(hole.pos) < hole.radius:
-                            self.balls.remove(ball)
-                            
-                            # Play the note for ball going into the hole
-                            inverse_velocity = Vector2(0, 0) - ball.vel  # Inverse the velocity
-                            midi_note = self.get_midi_note_from_velocity(inverse_velocity)
-                            self.midi_instrument.play_collision_sound(midi_note)
-
-                            if ball == self.cue_ball:  # If cue ball goes into the hole
-                                ball.pos = self.get_free_position()
-                                ball.vel = Vector2(0, 0)
-                                self.balls.append(ball)  # Add back the cue ball
-                            elif self.current_player == 1:
-                                self.score_player1 += 1  # Opponent gets the point
-                            else:
-                                self.score_player2 += 1
-                            self.player_scored = True  # Set the flag when a player scores
-                            break
-
-                    # Handle ball-ball collision
-                    for ball2 in self.balls[i+1:]:
-                        if self.handle_ball_collision(ball, ball2):
-                            average_velocity = (ball.vel + ball2.vel) / 2  # Compute the average velocity
-                            midi_note = self.get_midi_note_from_velocity(average_velocity)
-                            self.midi_instrument.play_collision_sound(midi_note)  # Play the note based on average velocity
-
-                # After processing all balls, check if they have all stopped moving
-                all_balls_stopped = all(ball.vel == Vector2(0, 0) for ball in self.balls)
-
-                if all_balls_stopped and self.ball_was_moving:
-                    if not self.player_scored:  # Only switch players if the current player did not score
-                        if self.current_player == 1:
-                            self.current_player = 2
-                        else:
-                            self.current_player = 1
-                    self.player_scored = False  # Reset the flag for the next turn
-
-                # Update the ball_was_moving flag for the next frame
-                self.ball_was_moving = not all_balls_stopped
-
-                # Update the ball_was_moving flag for the next frame
-                self.ball_was_moving = not all_balls_stopped
-                # This assumes you have an instance of PoolStick as self.pool_stick and cue ball as self.cue_ball
-                if not self.cue_ball.vel == Vector2(0, 0):  # Check if the cue ball is in motion
-                    self.pool_stick.update_start_position(self.cue_ball.pos)
-
-                try:
-                    self.handle_ball_drag(event, self.cue_ball)
-                    self.pool_stick.draw(self.screen)
-                except:
-                    pass
-                
-                self.draw_score()
+                    else:
+                        self.sim_inputs.put((time.perf_counter(), event))
+
+                snapshot = self.snapshot_buffer.wait_newer(1 / FPS)
+                if snapshot is None:
+                    continue
+                late_aim = self.is_dragging and snapshot.stick[0]
+                self.render_snapshot(snapshot, late_aim)
+                aim_time = self.draw_late_aim(snapshot) if late_aim else None
                 pygame.display.flip()
+                self.stats.record_frame(snapshot, aim_time)
+            except:
+                pass
 
-                self.p += self.direction * self.delta_p
-                if self.p > 1:
-                    self.p = 1
-                    self.direction = -1
-                elif self.p < 0:
-                    self.p = 0
-                    self.direction = 1
+        self.sim_running = False
+        simulation.join(timeout=1)
+        self.sim_inputs = None
 
-                self.clock.tick(60)
+    def _simulation_loop(self):
+        last = deadline = time.perf_counter()
+        while self.sim_running:
+            try:
+                idle = self.throttled = not self.ball_was_moving and not self.is_dragging
+                if idle:
+                    deadline = time.perf_counter() + IDLE_FRAME_MS / 1000
+                else:
+                    # Fixed 60 Hz schedule, if a step overran the next one starts right away
+                    deadline = max(deadline + 1 / FPS, time.perf_counter())
+                input_time = None
+                for timestamp, item in self._collect_inputs(deadline, wake_on_input=idle):
+                    input_time = timestamp if input_time is None else min(input_time, timestamp)
+                    if callable(item):
+                        item()
+                    else:
+                        self.handle_event(item)
+
+                self.simulate_frame()
+                idle = self._stayed_idle(idle)
+                self.snapshot_buffer.publish(self.take_snapshot(input_time))
+                if self.spectators is not None:
+                    self.spectators.publish(self)
+
+                now = time.perf_counter()
+                self.advance_p(max(1, round((now - last) * FPS)) if idle else 1)
+                last = now
             except:
                 pass
-        pygame.quit()
-        
+
+    def _stayed_idle(self, idle):
+        # Called after simulate_frame. A frame that applied an input (local or from the opponent) or set a ball
+        # moving must advance p by exactly one step, the other peer plays the same shot one step per frame.
+        # Only a table that stayed at rest may catch the morph up on the time slept in larger steps.
+        idle = idle and not self.ball_was_moving and not self.input_applied
+        self.input_applied = False
+        return idle
+
+    def _collect_inputs(self, deadline, wake_on_input):
+        # Gathers queued input until the frame deadline, when idle the first input ends the wait early
+        items = []
+        while True:
+            timeout = deadline - time.perf_counter()
+            try:
+                items.append(self.sim_inputs.get(timeout=timeout) if timeout > 0 else self.sim_inputs.get_nowait())
+            except queue.Empty:
+                return items
+            if wake_on_input:
+                while True:
+                    try:
+                        items.append(self.sim_inputs.get_nowait())
+                    except queue.Empty:
+                        return items
+
+    def handle_event(self, event):
+        # Returns False when the window is closed
+        if event.type == QUIT:
+            return False
+        elif event.type == KEYDOWN:
+            if event.key == pygame.K_UP:
+                self.midi_instrument.note_up()
+            elif event.key == pygame.K_DOWN:
+                self.midi_instrument.note_down()
+            elif event.key == pygame.K_LEFT:
+                self.midi_instrument.instrument_down()
+            elif event.key == pygame.K_RIGHT:
+                self.midi_instrument.instrument_up()
+            elif event.key == pygame.K_r and self.is_local_turn():
+                self.send_input('rotate')
+            elif event.key == pygame.K_q and self.is_local_turn():
+                self.send_input('flip_x')
+            elif event.key == pygame.K_e and self.is_local_turn():
+                self.send_input('flip_y')
+            elif event.key == pygame.K_u and self.can_undo():
+                self.send_input('undo')
+            elif event.key == pygame.K_ESCAPE:
+                self.display_menu = not self.display_menu
+        if event.type == MOUSEBUTTONDOWN:
+            self.mouse_button_up  = True
+        elif event.type == MOUSEBUTTONUP:
+            self.mouse_button_up  = False
+        # Every queued input reaches the aiming code, not just the last one of the frame
+        self.handle_ball_drag(event, self.cue_ball)
+        return True
+
+    def simulate_frame(self):
+        # Remote inputs land at the same point in the frame as local ones
+        self.process_network_messages()
+        if self.recording:
+            self._record_stick()
+
+        self.update_table(self.p)
+        if self.placing:
+            self.ball_in_hand.update_preview(self)
+        all_balls_stopped = not self.step_physics()
+        self.dispatch_events()
+
+        if all_balls_stopped and self.ball_was_moving:
+            self._end_shot()
+            self._on_table_rest()
+
+        # Update the ball_was_moving flag for the next frame
+        self.ball_was_moving = not all_balls_stopped
+        # This assumes you have an instance of PoolStick as self.pool_stick and cue ball as self.cue_ball
+        if self.cue_ball.vel.x or self.cue_ball.vel.y:  # Check if the cue ball is in motion (resting balls are exactly zero)
+            self.pool_stick.update_start_position(self.cue_ball.pos)
+
+    def take_snapshot(self, input_time=None):
+        stick = self.pool_stick
+        trajectory = self.trajectory
+        return FrameSnapshot(
+            frame=self.events.frame,
+            table_points=self.current_table_points,  # Replaced, never mutated, by update_table
+            holes=self.holes,
+            balls=tuple((ball.pos.x, ball.pos.y, ball.angle, ball.offset, ball.color, ball.is_striped) for ball in self.balls),
+            stick=(stick.is_visible, tuple(stick.start_position), tuple(stick.end_position)),
+            trajectory=(trajectory.path, trajectory.ghost, trajectory.object_path),
+            score_player1=self.score_player1,
+            score_player2=self.score_player2,
+            current_player=self.current_player,
+            p=self.p,
+            display_menu=self.display_menu,
+            input_time=input_time,
+            cue_pos=tuple(self.cue_ball.pos),
+            placement=self.ball_in_hand.preview if self.placing else None,
+            groups=tuple(self.groups),
+            winner=self.winner,
+            idle=self.throttled,
+        )
+
+    def render_snapshot(self, snapshot, late_aim=False):
+        # With late_aim the stick and aim line are left out, draw_late_aim adds them just before the flip
+        self.screen.fill(self.WHITE) # fill the background whatever color
+        self.draw_table(snapshot.table_points, snapshot.holes)
+
+        ball = self._render_ball
+        for x, y, angle, offset, color, is_striped in snapshot.balls:
+            ball.pos.update(x, y)
+            ball.angle, ball.offset, ball.color, ball.is_striped = angle, offset, color, is_striped
+            ball.draw(self.screen)
+        for hole in snapshot.holes:  # Pockets go over the balls dropping into them
+            hole.draw(self.screen)
+
+        if not late_aim:
+            self._draw_aim(snapshot.stick, snapshot.trajectory)
+        if snapshot.placement is not None:
+            self.ball_in_hand.draw(self.screen, snapshot.placement)
+
+        self.draw_score(snapshot)
+
+    def draw_late_aim(self, snapshot):
+        # Everything else of the frame is drawn, read the mouse once more so the stick is as fresh as possible
+        # when it reaches the screen. Returns when the mouse was read.
+        pygame.event.pump()  # Updates the mouse position without taking events off the queue
+        aim_time = time.perf_counter()
+        mouse_pos = pygame.mouse.get_pos()
+        if self.sim_inputs is None:
+            # Serial, this thread owns the game state and can re-aim for real, the aim line is usually cached
+            self.update_pool_stick_position(mouse_pos, self.cue_ball)
+            stick, trajectory = self.pool_stick, self.trajectory
+            self._draw_aim((stick.is_visible, tuple(stick.start_position), tuple(stick.end_position)),
+                           (trajectory.path, trajectory.ghost, trajectory.object_path))
+        else:
+            # Pipelined, the simulation thread owns the game, only the stick follows the mouse from here
+            aim = self.aim_stick(Vector2(snapshot.cue_pos), mouse_pos)
+            stick = (True, tuple(aim[0]), tuple(aim[1])) if aim is not None else snapshot.stick
+            self._draw_aim(stick, snapshot.trajectory)
+        return aim_time
+
+    def _draw_aim(self, stick_state, trajectory_state):
+        stick = self._render_stick
+        stick.is_visible, start, end = stick_state
+        if stick.is_visible:
+            trajectory = self._render_trajectory
+            trajectory.path, trajectory.ghost, trajectory.object_path = trajectory_state
+            trajectory.draw(self.screen)
+            stick.set_start_position(start)
+            stick.set_end_position(end)
+            stick.draw(self.screen)
+
+    def step_physics(self):
+        # Advances every ball one frame. Nothing here draws, plays sound or scores, what happened is
+        # emitted into self.events for dispatch_events. Returns True while any ball is still moving.
+        events = self.events
+        balls = self.balls
+        n = len(balls)
+        pocketed = None
+        for i in range(n):
+            ball = balls[i]
+            self.move_ball(ball)
+            if self.handle_ball_polygon_collision(ball):  # wall collide
+                events.emit(BALL_RAIL, ball.number, -1, ball.vel.length(), ball.pos.x, ball.pos.y)
+
+            dropped = False
+            for h, hole in enumerate(self.holes):
+                if ball.pos.distance_squared_to(hole.pos) < hole.radius * hole.radius:
+                    events.emit(SCRATCH if ball is self.cue_ball else POCKET, ball.number, h, ball.vel.length(), ball.pos.x, ball.pos.y)
+                    if pocketed is None:
+                        pocketed = []
+                    pocketed.append(ball)
+                    dropped = True
+                    break
+            if dropped:
+                continue
+
+            for j in range(i + 1, n):
+                ball2 = balls[j]
+                if self.handle_ball_collision(ball, ball2):
+                    # Average velocity of the pair, what the collision sound is pitched from
+                    speed = math.hypot((ball.vel.x + ball2.vel.x) / 2, (ball.vel.y + ball2.vel.y) / 2)
+                    events.emit(BALL_BALL, ball.number, ball2.number, speed, ball.pos.x, ball.pos.y)
+
+        # Pocketed balls leave the table only after the step, the list isn't changed while it's walked
+        if pocketed is not None:
+            self.balls = [ball for ball in balls if ball not in pocketed]
+        events.frame += 1
+        for ball in self.balls:
+            if ball.vel.x or ball.vel.y:  # Ball.move zeroes resting balls exactly
+                return True
+        return False
+
+    def dispatch_events(self):
+        events = self.events.drain()
+        if len(events) == 0:
+            return
+        self._play_event_sounds(events)
+        if self.shot is not None:
+            self._summarize_shot(events)
+        self._respot_scratch(events)
+
+    def _play_event_sounds(self, events):
+        # Ball-ball hits and pockets make a sound, several hits on the same note in one frame play it once
+        audible = events[(events['kind'] == BALL_BALL) | (events['kind'] == POCKET) | (events['kind'] == SCRATCH)]
+        for midi_note in np.unique(self.get_midi_notes_from_speeds(audible['speed'])):
+            self.midi_instrument.play_collision_sound(int(midi_note))
+
+    def _summarize_shot(self, events):
+        # Folds one frame's events into the running shot summary, the rules only look at the summary
+        shot = self.shot
+        kind, a, b = events['kind'], events['a'], events['b']
+        rails_from = 0
+        if shot['first_contact'] < 0:
+            contact = np.flatnonzero((kind == BALL_BALL) & ((a == 0) | (b == 0)))
+            if len(contact) == 0:
+                rails_from = len(kind)
+            else:
+                first = contact[0]
+                shot['first_contact'] = b[first] if a[first] == 0 else a[first]
+                rails_from = first + 1
+        if (kind[rails_from:] == BALL_RAIL).any():
+            shot['rail_after_contact'] = True
+        dropped = a[kind == POCKET]
+        if len(dropped):
+            if shot['first_pocketed'] < 0:
+                shot['first_pocketed'] = dropped[0]
+            shot['pocketed'] |= ball_mask(dropped)
+        if (kind == SCRATCH).any():
+            shot['scratch'] = True
+
+    def _end_shot(self):
+        # The table came to rest, the rules decide the score, the groups and whose turn it is
+        if self.shot is None:
+            self.switch_player()
+            return
+        result = evaluate(self.shot)[0]
+        self.shot = None
+        shooter = self.current_player
+        if shooter == 1:
+            self.score_player1 += int(result['points'])
+        else:
+            self.score_player2 += int(result['points'])
+        if self.groups[shooter - 1] == OPEN and result['group'] != OPEN:
+            self.groups[shooter - 1] = int(result['group'])
+            self.groups[2 - shooter] = SOLIDS + STRIPES - int(result['group'])
+        if result['outcome']:
+            self.winner = shooter if result['outcome'] > 0 else 3 - shooter
+        if not result['continues']:
+            self.switch_player()
+
+    def _respot_scratch(self, events):
+        if (events['kind'] == SCRATCH).any():
+            self.cue_ball.pos = self.get_free_position()
+            self.cue_ball.vel = Vector2(0, 0)
+            self.balls.append(self.cue_ball)  # Add back the cue ball
+
+    def wait_for_events(self, timeout):
+        # Blocks until there is input or the timeout runs out, then takes everything else that is queued
+        event = pygame.event.wait(timeout)
+        events = [] if event.type == NOEVENT else [event]
+        events.extend(pygame.event.get())
+        return events
+
+    def advance_p(self, steps=1):
+        if self.recording and steps != 1:  # Replays assume one step per frame unless told otherwise
+            self.replay['advances'].append([self.events.frame - 1 - self.record_origin, steps])
+        for _ in range(steps):
+            self.p += self.direction * self.delta_p
+            if self.p > 1:
+                self.p = 1
+                self.direction = -1
+            elif self.p < 0:
+                self.p = 0
+                self.direction = 1
+
     def get_midi_note_from_velocity(self, velocity, max_velocity=127, midpoint=32, scale_factor=2):  
         # The scale_factor controls the sensitivity around the midpoint
         midpoint_normalized = midpoint / 127.0
@@ -890,6 +1938,11 @@ class Turtle_Pool:
         midi_note = int((y + 1) / 2 * 127)
         return midi_note
 
+    def get_midi_notes_from_speeds(self, speeds, max_velocity=127, midpoint=32, scale_factor=2):
+        # Same mapping as get_midi_note_from_velocity for a whole array of speeds at once
+        y = np.tanh((np.asarray(speeds, dtype=np.float64) / max_velocity - midpoint / 127.0) * scale_factor)
+        return ((y + 1) / 2 * 127).astype(np.int64)
+
 class MidiInstrument:
     # Sound effect engine using mido's midi capabilities along with threading.
     def __init__(self):
@@ -958,6 +2011,133 @@ class MidiInstrument:
         time.sleep(0.0625 * 4)
         self.note_off(midi_note, shifted_note)
         
+class SilentInstrument:
+    # Stand-in for MidiInstrument in headless runs (replay export, analysis), same interface, no sound
+    def __init__(self, instrument=115):
+        self.instrument = instrument
+        self.current_note = 64
+
+    def change_instrument(self, instrument):
+        self.instrument = instrument
+
+    def instrument_up(self):
+        self.instrument = (self.instrument + 1) % 128
+
+    def instrument_down(self):
+        self.instrument = (self.instrument - 1) % 128
+
+    def note_up(self):
+        self.current_note = min(self.current_note + 1, 127)
+
+    def note_down(self):
+        self.current_note = max(self.current_note - 1, 0)
+
+    def stop_sound(self, midi_note):
+        pass
+
+    def play_collision_sound(self, midi_note):
+        pass
+
+SAMPLE_RATE = 44100
+SAMPLE_NOTE_LENGTH = 0.25  # Same as the MIDI note length, 0.0625 * 4
+SAMPLE_RELEASE = 0.03  # Fade out at the end so notes don't click
+SAMPLE_CHANNELS = 16
+SAMPLE_PRELOAD_NOTES = range(33, 72)  # What get_midi_notes_from_speeds gives for speeds up to about 40 px per frame
+
+# A rough voice per General MIDI family (program // 8): harmonic amplitudes, attack and decay in seconds, noise level
+SAMPLE_VOICES = [
+    ((1, .5, .3, .2, .1), .005, .25, 0),  # Piano
+    ((1, 0, .4, 0, .2), .002, .3, 0),  # Chromatic percussion
+    ((1, .8, .6, .4, .3, .2), .01, 2.0, 0),  # Organ
+    ((1, .6, .4, .3, .2, .1), .003, .3, 0),  # Guitar
+    ((1, .5, .2), .005, .3, 0),  # Bass
+    ((1, .5, .33, .25, .2), .05, 1.0, 0),  # Strings
+    ((1, .5, .33, .25, .2), .08, 1.0, .02),  # Ensemble
+    ((1, .9, .7, .5, .3), .03, .8, 0),  # Brass
+    ((1, 0, .5, 0, .3, 0, .2), .02, .8, 0),  # Reed
+    ((1, .1, .05), .03, .8, .05),  # Pipe
+    ((1, .5, .33, .25, .2, .17, .14, .12), .005, .6, 0),  # Synth lead
+    ((1, .5, .3), .1, 1.5, 0),  # Synth pad
+    ((1, .3, .6, .2), .05, .8, .1),  # Synth effects
+    ((1, .7, .5, .3, .2), .003, .4, 0),  # Ethnic
+    ((1, .2, .1), .001, .06, .3),  # Percussive, the default woodblock
+    ((.3,), .01, .3, .8),  # Sound effects
+]
+
+class SampleBankInstrument:
+    # Collision sounds without a MIDI device. Each note of the current program is synthesized once with NumPy
+    # and kept as a pygame Sound, playing one is a single non-blocking call on a fixed pool of mixer channels.
+    # Same interface as MidiInstrument.
+    def __init__(self, instrument=115, channels=SAMPLE_CHANNELS):
+        # A small buffer keeps the mixer's own latency down, must happen before pygame.init opens it by default
+        pygame.mixer.init(SAMPLE_RATE, -16, 1, 256, allowedchanges=0)
+        pygame.mixer.set_num_channels(channels)
+        self.channels = [pygame.mixer.Channel(i) for i in range(channels)]
+        self.next_channel = 0
+        self.playing = {}  # Note to the channel it was last played on
+        self.bank = {}
+        self.instrument = instrument
+        self.current_note = 64
+        self.change_instrument(instrument)
+        for note in SAMPLE_PRELOAD_NOTES:
+            self._sound((note + 12) % 128)
+
+    def change_instrument(self, instrument):
+        # The bank belongs to one program, notes of the new one are synthesized as they are first played
+        self.instrument = instrument
+        self.bank = {}
+
+    def instrument_up(self):
+        self.change_instrument((self.instrument + 1) % 128)
+
+    def instrument_down(self):
+        self.change_instrument((self.instrument - 1) % 128)
+
+    def note_up(self):
+        self.current_note = min(self.current_note + 1, 127)
+
+    def note_down(self):
+        self.current_note = max(self.current_note - 1, 0)
+
+    def stop_sound(self, midi_note):
+        channel = self.playing.pop(midi_note, None)
+        if channel is not None:
+            channel.stop()
+
+    def play_collision_sound(self, midi_note):
+        shifted_note = (midi_note + 12) % 128  # Increase by an octave for the sound effect
+        # Round robin, with more notes at once than channels the oldest one is cut off
+        channel = self.channels[self.next_channel]
+        self.next_channel = (self.next_channel + 1) % len(self.channels)
+        channel.play(self._sound(shifted_note))
+        self.playing[midi_note] = channel
+
+    def _sound(self, note):
+        sound = self.bank.get(note)
+        if sound is None:
+            sound = pygame.mixer.Sound(buffer=self.synthesize(note).tobytes())
+            self.bank[note] = sound
+        return sound
+
+    def synthesize(self, note):
+        # int16 samples of one note of the current program
+        harmonics, attack, decay, noise = SAMPLE_VOICES[self.instrument // 8]
+        frequency = 440 * 2 ** ((note - 69) / 12)
+        t = np.arange(int(SAMPLE_RATE * SAMPLE_NOTE_LENGTH)) / SAMPLE_RATE
+        amplitudes = np.array(harmonics, dtype=np.float64)
+        orders = np.arange(1, len(amplitudes) + 1)
+        audible = orders * frequency < SAMPLE_RATE / 2  # Harmonics above Nyquist would alias
+        wave = amplitudes[audible] @ np.sin(2 * np.pi * frequency * np.outer(orders[audible], t))
+        if noise:
+            wave += noise * np.random.default_rng(note).uniform(-1, 1, len(t))
+        envelope = np.minimum(t / attack, 1) * np.exp(-t / decay)
+        envelope *= np.clip((SAMPLE_NOTE_LENGTH - t) / SAMPLE_RELEASE, 0, 1)
+        wave *= envelope
+        peak = np.abs(wave).max()
+        if peak > 0:
+            wave *= 0.5 / peak
+        return (wave * 32767).astype(np.int16)
+
 GM_INSTRUMENTS = {
     0: 'Acoustic Grand Piano', 1: 'Bright Acoustic Piano', 2: 'Electric Grand Piano', 
     3: 'Honky-tonk Piano', 4: 'Electric Piano 1', 5: 'Electric Piano 2',
@@ -1005,5 +2185,32 @@ if __name__ == '__main__':
     #turtle = Turtle_Pool() 
     #cProfile.run('turtle.run()')
 
-    turtle = Turtle_Pool()
-    turtle.run()
+    import argparse
+    parser = argparse.ArgumentParser(description='Turtle Pool')
+    parser.add_argument('--host', type=int, metavar='PORT', help='host a two player game on PORT')
+    parser.add_argument('--join', metavar='HOST:PORT', help='join a game hosted with --host')
+    parser.add_argument('--broadcast', type=int, metavar='PORT', help='stream the game to spectators on PORT')
+    parser.add_argument('--pipelined', action='store_true', help='simulate on a separate thread from drawing')
+    parser.add_argument('--stats', action='store_true', help='print frame time and input latency percentiles on exit')
+    parser.add_argument('--record', metavar='FILE', help='save a replay of the game to FILE on exit (see export_frames.py)')
+    parser.add_argument('--audio', choices=('midi', 'samples'), default='midi',
+                        help='collision sounds from a MIDI synth or from samples synthesized at startup')
+    args = parser.parse_args()
+
+    netplay = None
+    if args.host is not None:
+        netplay = LockstepPeer('0.0.0.0', args.host, listen=True).start()
+    elif args.join:
+        host, _, port = args.join.rpartition(':')
+        netplay = LockstepPeer(host or '127.0.0.1', int(port), listen=False).start()
+
+    spectators = SpectatorServer('0.0.0.0', args.broadcast).start() if args.broadcast is not None else None
+
+    instrument = SampleBankInstrument() if args.audio == 'samples' else MidiInstrument()
+
+    turtle = Turtle_Pool(netplay=netplay, spectators=spectators, instrument=instrument)
+    if args.record:
+        turtle.start_recording()
+    turtle.run(pipelined=args.pipelined, report_stats=args.stats)
+    if args.record:
+        turtle.save_replay(args.record)
@@ -0,0 +1,140 @@
+import asyncio, json, queue, socket, threading
+
+DEFAULT_PORT = 50007
+
+class LockstepPeer:
+    # Two-player link for deterministic lockstep play.
+    # Only inputs (shots, ball-in-hand, table rotation/flips and the p phase) travel over the wire,
+    # each client runs the same simulation. Messages are newline-delimited JSON over one TCP connection.
+    # The asyncio loop lives on its own thread so the pygame loop never blocks on the network.
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, listen=True):
+        self.host = host
+        self.port = port
+        self.listen = listen
+        self.player = 1 if listen else 2  # The host always breaks as player 1
+        self.inbox = queue.Queue()
+        self.on_message = None  # Called from the network thread after each message lands in the inbox
+        self.ready = threading.Event()
+        self.connected = threading.Event()
+        self.closed = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.writer = None
+        self.server = None
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait_ready(self, timeout=None):
+        # For a host this means the port is bound (useful with port 0), for a client that it is dialing
+        return self.ready.wait(timeout)
+
+    def wait_connected(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    def send(self, message):
+        # Safe to call from the game thread, the write is scheduled on the network loop.
+        if self.writer is None or self.closed.is_set():
+            return
+        data = (json.dumps(message, separators=(',', ':')) + '\n').encode()
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def poll(self):
+        # Drain every message received since the last frame without blocking.
+        messages = []
+        while True:
+            try:
+                messages.append(self.inbox.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout=1)
+
+    async def _shutdown(self):
+        # Close the socket properly so the opponent sees EOF instead of waiting on a dead connection
+        if self.server is not None:
+            self.server.close()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.loop.stop()
+
+    def _write(self, data):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(data)
+
+    def _deliver(self, message):
+        self.inbox.put(message)
+        if self.on_message is not None:
+            self.on_message()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        if self.listen:
+            self.loop.run_until_complete(self._serve())
+        else:
+            self.loop.create_task(self._connect())
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+            if self.server is not None:
+                self.server.close()
+            self.loop.close()
+
+    async def _serve(self):
+        self.server = await asyncio.start_server(self._on_client, self.host, self.port)
+        # Port 0 asks the OS for a free port, report the real one back
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _on_client(self, reader, writer):
+        if self.writer is not None:  # Only one opponent per game
+            writer.close()
+            return
+        await self._attach(reader, writer)
+
+    async def _connect(self, retries=50):
+        for _ in range(retries):
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                await asyncio.sleep(0.1)
+                continue
+            await self._attach(reader, writer)
+            return
+        self._deliver({'type': 'disconnect'})
+
+    async def _attach(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # One small message per shot, don't batch it
+        self.writer = writer
+        self.connected.set()
+        self._deliver({'type': 'connect'})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    self._deliver(json.loads(line))
+                except ValueError:
+                    continue
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        self._deliver({'type': 'disconnect'})
+        self.writer = None
+        writer.close()
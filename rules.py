@@ -0,0 +1,100 @@
+import numpy as np
+
+# Groups a player can be on
+OPEN, SOLIDS, STRIPES = 0, 1, 2
+
+# Ball sets as bitmasks, bit n is ball number n
+CUE_BALL = 1 << 0
+SOLID_BALLS = 0x00FE  # 1-7
+EIGHT_BALL = 1 << 8
+STRIPE_BALLS = 0xFE00  # 9-15
+ALL_BALLS = 0xFFFF
+
+# Everything the rules need to know about one shot, filled in while it plays out
+SHOT_SUMMARY = np.dtype([
+    ('on_table', '<u2'),  # Balls on the table when the shot was taken
+    ('group', 'u1'),  # Shooter's group at that time
+    ('is_break', '?'),
+    ('first_contact', 'i1'),  # Number of the first ball the cue ball touched, -1 for none
+    ('first_pocketed', 'i1'),  # Number of the first object ball that dropped, -1 for none
+    ('pocketed', '<u2'),  # Object balls that dropped
+    ('rail_after_contact', '?'),  # Any ball reached a rail after the first contact
+    ('scratch', '?'),
+])
+
+# What a shot means for the shooter
+SHOT_RESULT = np.dtype([
+    ('foul', '?'),
+    ('continues', '?'),  # Shooter stays at the table
+    ('group', 'u1'),  # Shooter's group after the shot, a legal first pocket on an open table decides it
+    ('points', 'u1'),  # Balls of the shooter's group dropped on a legal shot, none while the table is still open
+    ('outcome', 'i1'),  # 1 shooter won, -1 shooter lost, 0 game goes on
+])
+
+def new_shot(on_table, group, is_break):
+    summary = np.zeros((), dtype=SHOT_SUMMARY)
+    summary['on_table'] = on_table
+    summary['group'] = group
+    summary['is_break'] = is_break
+    summary['first_contact'] = -1
+    summary['first_pocketed'] = -1
+    return summary
+
+def ball_mask(numbers):
+    # Bitmask of the given ball numbers
+    mask = 0
+    for number in numbers:
+        mask |= 1 << int(number)
+    return mask
+
+def group_of(numbers):
+    numbers = np.asarray(numbers)
+    return np.where((numbers >= 1) & (numbers <= 7), SOLIDS, np.where(numbers >= 9, STRIPES, OPEN))
+
+def _popcount16(values):
+    return np.unpackbits(values.astype('>u2').view(np.uint8).reshape(-1, 2), axis=1).sum(axis=1)
+
+def _group_balls(group):
+    return np.where(group == SOLIDS, SOLID_BALLS, np.where(group == STRIPES, STRIPE_BALLS, SOLID_BALLS | STRIPE_BALLS))
+
+def evaluate(summaries):
+    # Scores a batch of SHOT_SUMMARY records at once, returns one SHOT_RESULT per shot.
+    # Eight-ball as the game plays it:
+    # - The cue ball has to touch a ball of the shooter's group first, any ball but the 8 while the table is
+    #   open, the 8 once the group is cleared. After that some ball has to reach a rail or drop.
+    # - A scratch is always a foul. On the break only a scratch is.
+    # - Dropping the 8 wins if the shot is legal and the group was already cleared (or on the break), otherwise
+    #   it loses.
+    # - The first legal pocket after the break decides an open table's groups.
+    # - The shooter carries on after a legal shot that dropped a ball of their group (any but the 8 while open).
+    # - Only legal shots score, and only once the shooter has a group, so the break scores nothing.
+    summaries = np.atleast_1d(summaries)
+    on_table = summaries['on_table'].astype(np.int64)
+    group = summaries['group'].astype(np.int64)
+    is_break = summaries['is_break']
+    first = summaries['first_contact'].astype(np.int64)
+    pocketed = summaries['pocketed'].astype(np.int64) & ~CUE_BALL
+    scratch = summaries['scratch']
+
+    cleared = (group != OPEN) & ((on_table & _group_balls(group)) == 0)
+    targets = np.where(cleared, EIGHT_BALL, _group_balls(group))
+    hit_target = (first > 0) & (((1 << np.maximum(first, 0)) & targets) != 0)
+    no_rail = ~summaries['rail_after_contact'] & (pocketed == 0)
+    foul = scratch | (~is_break & (~hit_target | no_rail))
+
+    eight_down = (pocketed & EIGHT_BALL) != 0
+    won = eight_down & ~foul & (is_break | cleared)
+    outcome = np.where(won, 1, np.where(eight_down, -1, 0))
+
+    chosen = group_of(summaries['first_pocketed'])
+    new_group = np.where((group == OPEN) & ~is_break & ~foul & ~eight_down, chosen, group)
+    own = pocketed & _group_balls(new_group) & ~EIGHT_BALL
+    points = np.where(~foul & (new_group != OPEN), _popcount16(own), 0)
+
+    results = np.zeros(len(summaries), dtype=SHOT_RESULT)
+    results['foul'] = foul
+    results['continues'] = ~foul & ~eight_down & (own != 0)
+    results['group'] = new_group
+    results['points'] = points
+    results['outcome'] = outcome
+    return results
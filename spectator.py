@@ -0,0 +1,249 @@
+import asyncio, struct, threading, time
+import numpy as np
+
+DEFAULT_PORT = 50008
+
+KEYFRAME, DELTA = 1, 2
+KEYFRAME_INTERVAL = 1.0  # Seconds between full snapshots, by the clock since an idle table publishes less often
+CLIENT_QUEUE_LIMIT = 32  # Messages a slow spectator may fall behind before deltas get dropped
+
+POS_SCALE = 8  # 1/8 pixel
+VEL_SCALE = 64
+ANGLE_SCALE = 65536 / (2 * np.pi)
+ROTATION_STEP = np.pi / 6
+
+# Every message is length-prefixed, then starts with kind, frame number and ball count
+FRAME_HEADER = struct.Struct('<BIB')
+# p, direction, rotation index, flip/current player flags, scores
+TABLE_STATE = struct.Struct('<HbBBBB')
+P_STATE = struct.Struct('<H')
+LENGTH = struct.Struct('<I')
+
+BALL_MOTION = np.dtype([('x', '<u2'), ('y', '<u2'), ('vx', '<i2'), ('vy', '<i2'), ('angle', '<u2'), ('offset', 'i1')])
+BALL_LOOK = np.dtype([('r', 'u1'), ('g', 'u1'), ('b', 'u1'), ('striped', 'u1')])
+
+def quantize_motion(motion):
+    # motion is an (n, 6) float array of x, y, vx, vy, stripe angle, stripe offset
+    packed = np.empty(len(motion), dtype=BALL_MOTION)
+    packed['x'] = np.clip(np.rint(motion[:, 0] * POS_SCALE), 0, 65535)
+    packed['y'] = np.clip(np.rint(motion[:, 1] * POS_SCALE), 0, 65535)
+    packed['vx'] = np.clip(np.rint(motion[:, 2] * VEL_SCALE), -32768, 32767)
+    packed['vy'] = np.clip(np.rint(motion[:, 3] * VEL_SCALE), -32768, 32767)
+    packed['angle'] = np.rint(np.mod(motion[:, 4], 2 * np.pi) * ANGLE_SCALE).astype(np.int64) % 65536
+    packed['offset'] = np.clip(np.rint(motion[:, 5]), -128, 127)
+    return packed
+
+def dequantize_motion(packed):
+    motion = np.empty((len(packed), 6))
+    motion[:, 0] = packed['x'] / POS_SCALE
+    motion[:, 1] = packed['y'] / POS_SCALE
+    motion[:, 2] = packed['vx'] / VEL_SCALE
+    motion[:, 3] = packed['vy'] / VEL_SCALE
+    motion[:, 4] = packed['angle'] / ANGLE_SCALE
+    motion[:, 5] = packed['offset']
+    return motion
+
+def _table_state(table):
+    p, direction, rotation_angle, flip_x, flip_y, current_player, score1, score2 = table
+    flags = flip_x | flip_y << 1 | (current_player == 2) << 2
+    rotation = int(round(rotation_angle / ROTATION_STEP)) % 12
+    return TABLE_STATE.pack(int(round(p * 65535)), direction, rotation, flags, score1 & 255, score2 & 255)
+
+class _Spectator:
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = asyncio.Queue(CLIENT_QUEUE_LIMIT)
+        self.needs_keyframe = False
+        self.task = asyncio.current_task()  # Serving this viewer, cancelled on shutdown
+
+    def offer(self, message, is_keyframe):
+        # Never blocks the broadcaster, a full queue just means this viewer skips ahead to the next keyframe
+        if self.needs_keyframe and not is_keyframe:
+            return
+        try:
+            self.queue.put_nowait(message)
+            self.needs_keyframe = False
+        except asyncio.QueueFull:
+            self.needs_keyframe = True
+
+class SpectatorServer:
+    # Streams a live game to any number of viewers.
+    # The game loop only hands over a small snapshot per frame, quantizing, delta packing and all socket
+    # writes happen on the server's own asyncio thread. Each viewer has a bounded queue so a slow
+    # connection can't hold up the others, and late joiners start from a keyframe of the current frame.
+    def __init__(self, host='0.0.0.0', port=DEFAULT_PORT, keyframe_interval=KEYFRAME_INTERVAL):
+        self.host = host
+        self.port = port
+        self.keyframe_interval = keyframe_interval
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.server = None
+        self.spectators = set()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+
+        self.frame = 0
+        self.last_sent = None  # Quantized motion the viewers currently have
+        self.last_looks = None
+        self.last_table = None
+        self.last_keyframe_time = None
+        self._pending = None
+        self._wakeup_pending = False
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def publish(self, game):
+        # Called from the game loop once per frame, must stay cheap
+        balls = game.balls
+        motion = np.array([(ball.pos.x, ball.pos.y, ball.vel.x, ball.vel.y, ball.angle, ball.offset) for ball in balls], dtype=np.float64).reshape(-1, 6)
+        looks = tuple((ball.color, ball.is_striped) for ball in balls)
+        table = (game.p, game.direction, game.rotation_angle, game.flip_x, game.flip_y,
+                 game.current_player, game.score_player1, game.score_player2)
+        self._pending = (motion, looks, table)
+        # Coalesce, if the server thread is behind it simply encodes the newest frame
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._encode_pending)
+
+    def close(self):
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        if self.thread.is_alive():
+            self.thread.join(timeout=1)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._serve())
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def _serve(self):
+        self.server = await asyncio.start_server(self._on_spectator, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _shutdown(self):
+        # Every viewer's task has to finish before the loop stops, or it is destroyed while still pending
+        self.server.close()
+        tasks = [spectator.task for spectator in self.spectators]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    async def _on_spectator(self, reader, writer):
+        spectator = _Spectator(writer)
+        self.spectators.add(spectator)
+        if self.last_sent is None:
+            spectator.needs_keyframe = True
+        else:
+            # A keyframe of what the others have right now, not the last one plus a backlog of deltas
+            spectator.offer(self._encode_keyframe(self.last_sent, self.last_looks, self.last_table), True)
+        try:
+            while True:
+                message = await spectator.queue.get()
+                writer.write(message)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):  # Cancelled by _shutdown, end the handler quietly
+            pass
+        finally:
+            self.spectators.discard(spectator)
+            writer.close()
+
+    def _encode_pending(self):
+        self._wakeup_pending = False
+        motion, looks, table = self._pending
+        packed = quantize_motion(motion)
+        self.frame += 1
+
+        # Anything a delta can't express (pocketed ball, rotation, flip, score) forces a keyframe
+        is_keyframe = (self.last_sent is None or looks != self.last_looks or table[2:] != self.last_table[2:]
+                       or time.monotonic() - self.last_keyframe_time >= self.keyframe_interval)
+        if is_keyframe:
+            self.last_keyframe_time = time.monotonic()
+            message = self._encode_keyframe(packed, looks, table)
+        else:
+            message = self._encode_delta(packed, table)
+        self.last_sent = packed
+        self.last_looks = looks
+        self.last_table = table
+
+        for spectator in self.spectators:
+            spectator.offer(message, is_keyframe)
+
+    def _encode_keyframe(self, packed, looks, table):
+        look = np.array([(*color, is_striped) for color, is_striped in looks], dtype=np.uint8).reshape(-1, 4)
+        look = np.ascontiguousarray(look).view(BALL_LOOK).reshape(-1)
+        body = b''.join((FRAME_HEADER.pack(KEYFRAME, self.frame, len(packed)), _table_state(table),
+                         packed.tobytes(), look.tobytes()))
+        return LENGTH.pack(len(body)) + body
+
+    def _encode_delta(self, packed, table):
+        # A bitmask of the balls whose quantized state changed, followed by only those balls
+        moved = packed != self.last_sent
+        body = b''.join((FRAME_HEADER.pack(DELTA, self.frame, len(packed)), P_STATE.pack(int(round(table[0] * 65535))),
+                         np.packbits(moved).tobytes(), packed[moved].tobytes()))
+        return LENGTH.pack(len(body)) + body
+
+class SpectatorDecoder:
+    # Rebuilds the table on the viewer side from the keyframe/delta stream.
+    def __init__(self):
+        self.frame = None
+        self.packed = None
+        self.looks = None
+        self.p = 0.0
+        self.direction = 1
+        self.rotation_angle = 0.0
+        self.flip_x = self.flip_y = False
+        self.current_player = 1
+        self.score_player1 = self.score_player2 = 0
+
+    def feed(self, body):
+        # Returns False until the first keyframe has been seen
+        kind, frame, count = FRAME_HEADER.unpack_from(body)
+        offset = FRAME_HEADER.size
+        if kind == KEYFRAME:
+            p, self.direction, rotation, flags, self.score_player1, self.score_player2 = TABLE_STATE.unpack_from(body, offset)
+            offset += TABLE_STATE.size
+            self.p = p / 65535
+            self.rotation_angle = rotation * ROTATION_STEP
+            self.flip_x, self.flip_y = bool(flags & 1), bool(flags & 2)
+            self.current_player = 2 if flags & 4 else 1
+            self.packed = np.frombuffer(body, BALL_MOTION, count, offset).copy()
+            offset += count * BALL_MOTION.itemsize
+            self.looks = np.frombuffer(body, BALL_LOOK, count, offset).copy()
+        elif kind == DELTA:
+            if self.packed is None or len(self.packed) != count:
+                return False
+            self.p = P_STATE.unpack_from(body, offset)[0] / 65535
+            offset += P_STATE.size
+            mask_size = (count + 7) // 8
+            moved = np.unpackbits(np.frombuffer(body, np.uint8, mask_size, offset), count=count).astype(bool)
+            offset += mask_size
+            self.packed[moved] = np.frombuffer(body, BALL_MOTION, int(moved.sum()), offset)
+        self.frame = frame
+        return True
+
+    def balls(self):
+        # (n, 6) float array of x, y, vx, vy, stripe angle, stripe offset
+        return dequantize_motion(self.packed)
+
+async def watch(host='127.0.0.1', port=DEFAULT_PORT):
+    # Minimal viewer client, yields the decoder after every message that updates the table
+    reader, writer = await asyncio.open_connection(host, port)
+    decoder = SpectatorDecoder()
+    try:
+        while True:
+            length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+            if decoder.feed(await reader.readexactly(length)):
+                yield decoder
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,35 @@
+import os
+# Headless: no window, no sound device. Has to be set before pygame is initialized.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import sys, tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Turtle_Pool, SilentInstrument
+
+FRAMES = 60
+WARMUP_FRAMES = 30
+PEAK_BUDGET = 64 * 1024  # Bytes live at once over the measured frames, a steady frame needs a few KB
+
+def test_steady_state_frame_allocation():
+    game = Turtle_Pool(instrument=SilentInstrument())
+    game.setup_balls()
+    game.send_input('shot', vel=[0, 22])  # Break, so the frames measured have balls colliding and rolling
+    for _ in range(WARMUP_FRAMES):
+        game.simulate_frame()
+        game.advance_p()
+    assert game.ball_was_moving
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for _ in range(FRAMES):
+            game.simulate_frame()
+            game.advance_p()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    assert game.ball_was_moving
+    assert peak < PEAK_BUDGET, f'{peak} bytes peak over {FRAMES} frames'
@@ -0,0 +1,97 @@
+import os
+# Headless: no window, no sound device. Has to be set before pygame is initialized.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from main import Turtle_Pool, SilentInstrument
+from netplay import LockstepPeer
+
+TIMEOUT = 5
+
+def receive(peer, kind, pump=None):
+    # Polls until a message of the given type arrives, pump runs a game frame in between
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        if pump is not None:
+            pump()
+        for message in peer.poll():
+            if message.get('type') == kind:
+                return message
+        time.sleep(0.01)
+    raise AssertionError(f'no {kind!r} message within {TIMEOUT} s')
+
+@pytest.fixture
+def peers():
+    host = LockstepPeer('127.0.0.1', 0, listen=True).start()
+    assert host.wait_ready(TIMEOUT)
+    client = LockstepPeer('127.0.0.1', host.port, listen=False).start()
+    assert client.wait_connected(TIMEOUT) and host.wait_connected(TIMEOUT)
+    yield host, client
+    client.close()
+    host.close()
+
+def test_shot_arrives(peers):
+    host, client = peers
+    receive(client, 'connect')
+    host.send({'type': 'shot', 'vel': [3.0, -15.0], 'p': 0.25, 'direction': 1, 'hash': 1})
+    message = receive(client, 'shot')
+    assert message['vel'] == [3.0, -15.0] and message['p'] == 0.25
+
+def test_hash_mismatch_resyncs(peers):
+    host, client = peers
+    host_game = Turtle_Pool(instrument=SilentInstrument(), netplay=host)
+    receive(client, 'state', host_game.simulate_frame)  # The host's table on connect
+
+    # An input whose hash doesn't match the host's table makes the host push its state
+    client.send({'type': 'switch_player', 'p': host_game.p, 'direction': host_game.direction, 'hash': 0})
+    receive(client, 'state', host_game.simulate_frame)
+
+    # The client asks the host for it instead
+    client_game = Turtle_Pool(instrument=SilentInstrument(), netplay=client)
+    host.send({'type': 'switch_player', 'p': client_game.p, 'direction': client_game.direction, 'hash': 0})
+    receive(host, 'resync', client_game.simulate_frame)
+
+def test_close_disconnects(peers):
+    host, client = peers
+    receive(host, 'connect')
+    client.close()
+    receive(host, 'disconnect')
+
+def settle(game, frames=3000):
+    for _ in range(frames):
+        game.simulate_frame()
+        game.advance_p()
+        if not game.ball_was_moving:
+            return
+    raise AssertionError('table never came to rest')
+
+def test_only_the_shooter_can_undo(peers):
+    host, client = peers
+    host_game = Turtle_Pool(instrument=SilentInstrument(), netplay=host)
+    client_game = Turtle_Pool(instrument=SilentInstrument(), netplay=client)
+    receive(client, 'connect')
+    host_game.simulate_frame()  # Sends the host's table
+    receive(client, 'state')
+    client_game.import_state(host_game.export_state())
+
+    host_game.send_input('shot', vel=[0, -8])  # Away from the rack, a miss that passes the turn
+    settle(host_game)
+    deadline = time.monotonic() + TIMEOUT
+    while client_game.shot_count == 0 and time.monotonic() < deadline:
+        client_game.simulate_frame()
+        time.sleep(0.01)
+    settle(client_game)
+    assert host_game.current_player == client_game.current_player == 2
+
+    assert host_game.can_undo() and not client_game.can_undo()
+    host_game.send_input('undo')
+    deadline = time.monotonic() + TIMEOUT
+    while client_game.current_player != 1 and time.monotonic() < deadline:
+        client_game.simulate_frame()
+        time.sleep(0.01)
+    assert host_game.current_player == client_game.current_player == 1
+    assert host_game.get_state_hash() == client_game.get_state_hash()
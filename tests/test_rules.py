@@ -0,0 +1,104 @@
+import os
+# Headless: no window, no sound device. Has to be set before pygame is initialized.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+import main
+from pygame.math import Vector2
+from main import Turtle_Pool, SilentInstrument
+from rules import OPEN, SOLIDS, STRIPES, SOLID_BALLS, ALL_BALLS, SHOT_SUMMARY, ball_mask, evaluate as evaluate_shots
+
+def test_resting_balls_on_a_moving_rail_are_not_a_rail_contact(monkeypatch):
+    game = Turtle_Pool(instrument=SilentInstrument())
+    game.setup_balls()
+    game.update_table(game.p)
+    game.is_break = False
+    # Every object ball but one rests on the cushion, well away from the pockets, where the morphing table keeps
+    # pushing them
+    centre = Vector2(game.WIDTH / 2, game.HEIGHT / 2)
+    cushion = [Vector2(point) for point in game.cushion_points
+               if min(Vector2(point).distance_to(hole.pos) for hole in game.holes) > 4 * game.holes[0].radius]
+    for n, ball in enumerate(game.balls[2:]):
+        ball.pos = cushion[n * len(cushion) // 14]
+    target = game.balls[1]
+    target.pos = Vector2(centre)
+    game.cue_ball.pos = centre + Vector2(0, -40)
+
+    summaries = []
+    evaluate = main.evaluate
+    monkeypatch.setattr(main, 'evaluate', lambda shot: summaries.append(shot.copy()) or evaluate(shot))
+    game.send_input('shot', vel=[0, 1])  # A tap into the centre ball, nothing gets near a rail
+    for _ in range(3000):
+        game.simulate_frame()
+        game.advance_p()
+        if not game.ball_was_moving:
+            break
+
+    shot, = summaries
+    assert shot['first_contact'] == target.number
+    assert not shot['rail_after_contact']
+    assert shot['pocketed'] == 0
+    assert evaluate(shot)[0]['foul']
+
+SOLIDS_CLEARED = ALL_BALLS & ~SOLID_BALLS
+
+# on_table, group, is_break, first contact, pocketed in order, rail after contact, scratch ->
+# foul, continues, group after, points, outcome
+SHOTS = [
+    # The break
+    ((ALL_BALLS, OPEN, True, 1, [3, 10], False, False), (False, True, OPEN, 0, 0)),
+    ((ALL_BALLS, OPEN, True, 1, [], True, False), (False, False, OPEN, 0, 0)),
+    ((ALL_BALLS, OPEN, True, 1, [8], False, False), (False, False, OPEN, 0, 1)),
+    ((ALL_BALLS, OPEN, True, 1, [8], False, True), (True, False, OPEN, 0, -1)),
+    ((ALL_BALLS, OPEN, True, 1, [2], False, True), (True, False, OPEN, 0, 0)),
+    # Open table
+    ((ALL_BALLS, OPEN, False, 3, [3], False, False), (False, True, SOLIDS, 1, 0)),
+    ((ALL_BALLS, OPEN, False, 3, [10, 3], False, False), (False, True, STRIPES, 1, 0)),
+    ((ALL_BALLS, OPEN, False, 8, [3], False, False), (True, False, OPEN, 0, 0)),
+    ((ALL_BALLS, OPEN, False, 3, [], True, False), (False, False, OPEN, 0, 0)),
+    # Group hit first, or not
+    ((ALL_BALLS, SOLIDS, False, 3, [3, 5], False, False), (False, True, SOLIDS, 2, 0)),
+    ((ALL_BALLS, SOLIDS, False, 3, [10], False, False), (False, False, SOLIDS, 0, 0)),
+    ((ALL_BALLS, SOLIDS, False, 10, [3], False, False), (True, False, SOLIDS, 0, 0)),
+    ((ALL_BALLS, STRIPES, False, 8, [3], True, False), (True, False, STRIPES, 0, 0)),
+    # No rail
+    ((ALL_BALLS, SOLIDS, False, 3, [], False, False), (True, False, SOLIDS, 0, 0)),
+    ((ALL_BALLS, SOLIDS, False, 3, [], True, False), (False, False, SOLIDS, 0, 0)),
+    # Scratch
+    ((ALL_BALLS, SOLIDS, False, 3, [3], True, True), (True, False, SOLIDS, 0, 0)),
+    ((ALL_BALLS, SOLIDS, False, -1, [], False, True), (True, False, SOLIDS, 0, 0)),
+    # The 8
+    ((SOLIDS_CLEARED, SOLIDS, False, 8, [8], True, False), (False, False, SOLIDS, 0, 1)),
+    ((SOLIDS_CLEARED, SOLIDS, False, 8, [8], True, True), (True, False, SOLIDS, 0, -1)),
+    ((SOLIDS_CLEARED, SOLIDS, False, 10, [8], True, False), (True, False, SOLIDS, 0, -1)),
+    ((SOLIDS_CLEARED, SOLIDS, False, 3, [], True, False), (True, False, SOLIDS, 0, 0)),
+    ((ALL_BALLS, SOLIDS, False, 3, [3, 8], True, False), (False, False, SOLIDS, 1, -1)),
+    ((ALL_BALLS, OPEN, False, 3, [8], True, False), (False, False, OPEN, 0, -1)),
+]
+
+def summary(on_table, group, is_break, first, pocketed, rail, scratch):
+    shot = np.zeros((), dtype=SHOT_SUMMARY)
+    shot['on_table'] = on_table
+    shot['group'] = group
+    shot['is_break'] = is_break
+    shot['first_contact'] = first
+    shot['first_pocketed'] = pocketed[0] if pocketed else -1
+    shot['pocketed'] = ball_mask(pocketed)
+    shot['rail_after_contact'] = rail
+    shot['scratch'] = scratch
+    return shot
+
+@pytest.mark.parametrize('shot, expected', SHOTS)
+def test_evaluate(shot, expected):
+    result = evaluate_shots(summary(*shot))[0]
+    assert (bool(result['foul']), bool(result['continues']), int(result['group']), int(result['points']),
+            int(result['outcome'])) == expected
+
+def test_evaluate_batch_matches_single_shots():
+    batch = evaluate_shots(np.array([summary(*shot) for shot, _ in SHOTS]))
+    assert batch.tolist() == [evaluate_shots(summary(*shot))[0].tolist() for shot, _ in SHOTS]